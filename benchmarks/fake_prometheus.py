@@ -0,0 +1,155 @@
+"""
+    A local stand-in for the Prometheus HTTP API, answering the queries the proxy makes with
+    synthetic data, for the benchmarks.
+
+    Range queries return one series per object id in the query's label matcher, with a sample
+    at every step of the range; instant topk/bottomk queries return the n objects with the
+    highest or lowest synthetic peak; label values return the configured object ids. Every
+    response is delayed by latency_seconds, to stand in for the network and query time of a
+    real server.
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+MATCHER = re.compile (r'(\w+)(=~|=)"((?:[^"\\]|\\.)*)"')
+RANK = re.compile (r'^(topk|bottomk) \((\d+),')
+
+def unescape (value):
+    return re.sub (r"\\(.)", r"\1", value)
+
+def matcher_values (query):
+    # The label and the values of the first label matcher of the query, as written by prometheus.api.label_matcher
+    match = MATCHER.search (query)
+    if match is None:
+        return None, []
+
+    label, operator, value = match.groups ()
+    value = unescape (value)
+    if operator == "=":
+        return label, [value]
+    return label, [unescape (part) for part in re.split (r"(?<!\\)\|", value)]
+
+def base_value (object_id):
+    return (zlib.crc32 (object_id.encode ("utf-8")) % 1000) / 10.0
+
+def sample_value (object_id, timestamp, step):
+    return base_value (object_id) + (timestamp // step) % 10
+
+class FakePrometheus (object):
+    """
+        The fake server, on a background thread once started.
+
+        object_ids
+            The values of every label, as returned by the label values endpoint.
+
+        latency_seconds
+            Delay added to every response.
+    """
+
+    def __init__ (self, object_ids, latency_seconds = 0.0, hostname = "127.0.0.1", port = 0):
+        self.object_ids = list (object_ids)
+        self.latency_seconds = latency_seconds
+        self.requests = 0
+
+        server = self
+
+        class Handler (BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message (self, format, *args):
+                pass
+
+            def do_GET (self):
+                url = urlparse (self.path)
+                self.respond (url.path, parse_qs (url.query))
+
+            def do_POST (self):
+                length = int (self.headers.get ("Content-Length", 0))
+                self.respond (urlparse (self.path).path, parse_qs (self.rfile.read (length).decode ("utf-8")))
+
+            def respond (self, path, params):
+                server.requests += 1
+                if server.latency_seconds > 0:
+                    time.sleep (server.latency_seconds)
+
+                body = json.dumps (server.answer (path, dict ((k, v [0]) for k, v in params.items ()))).encode ("utf-8")
+                self.send_response (200)
+                self.send_header ("Content-Type", "application/json")
+                self.send_header ("Content-Length", str (len (body)))
+                self.end_headers ()
+                self.wfile.write (body)
+
+        self.httpd = ThreadingHTTPServer ((hostname, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port (self):
+        return self.httpd.server_address [1]
+
+    def answer (self, path, params):
+        if path == "/api/v1/query_range":
+            return self.range_query (params ["query"], float (params ["start"]), float (params ["end"]), float (params ["step"]))
+        if path == "/api/v1/query":
+            return self.instant_query (params ["query"], float (params.get ("time", time.time ())))
+        if path.startswith ("/api/v1/label/"):
+            return {"status": "success", "data": self.object_ids}
+
+        return {"status": "error", "errorType": "bad_data", "error": "unsupported path " + path}
+
+    def range_query (self, query, start_time, end_time, step):
+        label, object_ids = matcher_values (query)
+        step = int (step)
+        timestamps = range (int (start_time), int (end_time) + 1, step)
+
+        result = []
+        for object_id in sorted (object_ids):
+            values = [[t, str (sample_value (object_id, t, step))] for t in timestamps]
+            result.append ({"metric": {"__name__": query.split ("{", 1)[0].strip (), label: object_id}, "values": values})
+
+        return {"status": "success", "data": {"resultType": "matrix", "result": result}}
+
+    def instant_query (self, query, timestamp):
+        label, object_ids = matcher_values (query)
+        rank = RANK.match (query)
+        if rank is None:
+            samples = [(object_id, base_value (object_id)) for object_id in object_ids]
+        else:
+            # The peak of the synthetic series is its base value plus 9
+            peaks = [(object_id, base_value (object_id) + 9) for object_id in object_ids]
+            peaks.sort (key = lambda sample: sample [1], reverse = rank.group (1) == "topk")
+            samples = peaks [:int (rank.group (2))]
+
+        result = [{"metric": {label: object_id}, "value": [timestamp, str (value)]} for object_id, value in samples]
+        return {"status": "success", "data": {"resultType": "vector", "result": result}}
+
+    def start (self):
+        self.thread = threading.Thread (target = self.httpd.serve_forever, name = "fake-prometheus", daemon = True)
+        self.thread.start ()
+        return self
+
+    def stop (self):
+        self.httpd.shutdown ()
+        self.httpd.server_close ()
+
+def main ():
+    parser = argparse.ArgumentParser (description = "Fake Prometheus server with synthetic data")
+    parser.add_argument ('--port', help = "Port to listen on", type = int, default = 9090)
+    parser.add_argument ('--objects', help = "Number of synthetic object ids", type = int, default = 5000)
+    parser.add_argument ('--latency-ms', help = "Delay added to every response", type = float, default = 0.0)
+    args = parser.parse_args ()
+
+    server = FakePrometheus (["host-%05d" % i for i in range (args.objects)], latency_seconds = args.latency_ms / 1000.0,
+        port = args.port)
+    print ("Fake Prometheus listening on port %d" % (server.port))
+    server.httpd.serve_forever ()
+
+if __name__ == "__main__":
+    main ()
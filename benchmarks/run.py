@@ -0,0 +1,231 @@
+"""
+    Benchmarks of the proxy against a local fake Prometheus.
+
+    Builds the app with create_app, on the Prometheus models with a generated inventory of
+    synthetic objects, and drives it through Portal workloads:
+
+        catalog         the catalog requests of a Portal sync
+        time_series     time_series_data batches of --batch data requests, one object each
+        object_search   a wildcard object_search over every object
+        topn_search     a wildcard topn_search
+
+    and reports, per workload, the throughput and the p50/p99 latency, then the peak RSS of the
+    process. The fake Prometheus runs in its own process so it does not compete with the proxy
+    for the interpreter.
+
+    Run from the repository root:
+
+        python -m benchmarks.run --objects 5000 --batch 500 --latency-ms 5
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import yaml
+
+REPO = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+MODELS = os.path.join (REPO, "prometheus")
+
+WORKLOADS = ("catalog", "time_series", "object_search", "topn_search")
+
+CATALOG_ROUTES = ("software_version", "preferences", "granularities", "object_types", "launch_urls",
+                  "default_thresholds", "metrics", "statistics")
+
+GRANULARITIES = {"1m": 60, "15m": 900, "1h": 3600, "1d": 86400}
+
+def free_port ():
+    with socket.socket (socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind (("127.0.0.1", 0))
+        return s.getsockname () [1]
+
+def start_fake_prometheus (port, objects, latency_ms):
+    process = subprocess.Popen ([sys.executable, "-m", "benchmarks.fake_prometheus", "--port", str (port),
+        "--objects", str (objects), "--latency-ms", str (latency_ms)], cwd = REPO, stdout = subprocess.DEVNULL)
+
+    deadline = time.monotonic () + 10
+    while time.monotonic () < deadline:
+        try:
+            socket.create_connection (("127.0.0.1", port), timeout = 0.2).close ()
+            return process
+        except OSError:
+            time.sleep (0.05)
+
+    process.kill ()
+    raise RuntimeError ("The fake Prometheus did not start")
+
+def write_models (directory, objects, port, overrides):
+    # The Prometheus models and configuration, with a synthetic inventory and the fake server as the target
+    files = {}
+    for name in ("softwareversion", "metrics", "objecttypes", "granularities", "statistics"):
+        files [name] = shutil.copy (os.path.join (MODELS, "models-" + name + ".yaml"), directory)
+
+    files ["objects"] = os.path.join (directory, "models-objects.yaml")
+    with open (files ["objects"], "w") as f:
+        yaml.safe_dump ([{"object_id": "host-%05d" % i, "display_name": "Host %05d" % i, "object_type_id": "job"}
+                         for i in range (objects)], f)
+
+    with open (os.path.join (MODELS, "config.yaml")) as f:
+        config = yaml.safe_load (f)
+    config.update ({"target_hostname": "127.0.0.1", "target_port": port, "object_discovery": False,
+                    "model_reload_seconds": 0, "model_cache": False})
+    config.update (overrides)
+
+    files ["config"] = os.path.join (directory, "config.yaml")
+    with open (files ["config"], "w") as f:
+        yaml.safe_dump (config, f)
+
+    files ["callbacks"] = shutil.copy (os.path.join (MODELS, "callbacks.yaml"), directory)
+
+    return files
+
+def percentile (latencies, p):
+    ordered = sorted (latencies)
+    return ordered [max (int (math.ceil (p * len (ordered))) - 1, 0)]
+
+def time_window (args):
+    # A window ending on a step boundary, as Portal requests them
+    step = GRANULARITIES [args.granularity]
+    end_time = int (time.time ()) // step * step
+    return end_time - args.range_seconds, end_time
+
+def workload_requests (name, args):
+    """
+        Returns a function making one request of the workload with a Flask test client, and
+        checking its status.
+    """
+    objects = ["host-%05d" % i for i in range (args.objects)]
+    wildcard = json.dumps ([{"object_type_id": "job", "instance_id": "*"}])
+
+    def check (response):
+        if response.status_code != 200:
+            raise RuntimeError ("%s: HTTP %d" % (name, response.status_code))
+
+    if name == "catalog":
+        def request (client):
+            for route in CATALOG_ROUTES:
+                check (client.get ("/portal-api/v1/" + route))
+        return request
+
+    if name == "time_series":
+        def request (client):
+            start_time, end_time = time_window (args)
+            body = json.dumps ([{"data_request_id": i,
+                                 "object_filters": [{"object_type_id": "job", "instance_id": object_id}],
+                                 "metric_statistic_ids": [{"metric_id": "up", "statistic_id": args.statistic}]}
+                                for i, object_id in enumerate (random.sample (objects, min (args.batch, len (objects))))])
+            check (client.post ("/portal-api/v1/time_series_data?start_time_seconds=%d&end_time_seconds=%d&granularity_id=%s"
+                % (start_time, end_time, args.granularity), data = body, content_type = "application/json"))
+        return request
+
+    if name == "object_search":
+        def request (client):
+            check (client.post ("/portal-api/v1/object_search", data = wildcard, content_type = "application/json"))
+        return request
+
+    if name == "topn_search":
+        def request (client):
+            start_time, end_time = time_window (args)
+            check (client.post ("/portal-api/v1/topn_search?metric_id=up&n_value=10&ascending=false"
+                "&start_time_seconds=%d&end_time_seconds=%d" % (start_time, end_time), data = wildcard,
+                content_type = "application/json"))
+        return request
+
+    raise ValueError ("Unknown workload " + name)
+
+def run_workload (app, request, iterations, concurrency):
+    # iterations requests spread over concurrency threads, each with its own test client
+    latencies = []
+    lock = threading.Lock ()
+    remaining = [iterations]
+
+    def worker ():
+        client = app.test_client ()
+        while True:
+            with lock:
+                if remaining [0] == 0:
+                    return
+                remaining [0] -= 1
+
+            start = time.perf_counter ()
+            request (client)
+            elapsed = time.perf_counter () - start
+            with lock:
+                latencies.append (elapsed)
+
+    started = time.perf_counter ()
+    threads = [threading.Thread (target = worker) for i in range (concurrency)]
+    for thread in threads:
+        thread.start ()
+    for thread in threads:
+        thread.join ()
+    wall = time.perf_counter () - started
+
+    return {"requests": len (latencies), "seconds": wall, "throughput": len (latencies) / wall,
+            "p50_ms": percentile (latencies, 0.50) * 1000, "p99_ms": percentile (latencies, 0.99) * 1000}
+
+def peak_rss_mb ():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+def main ():
+    parser = argparse.ArgumentParser (description = "Benchmarks of the proxy against a local fake Prometheus")
+    parser.add_argument ('--objects', help = "Objects in the inventory", type = int, default = 5000)
+    parser.add_argument ('--batch', help = "Data requests per time_series_data call", type = int, default = 500)
+    parser.add_argument ('--range-seconds', help = "Time range of the data requests", type = int, default = 3600)
+    parser.add_argument ('--granularity', help = "Granularity of the data requests", choices = sorted (GRANULARITIES), default = "1m")
+    parser.add_argument ('--statistic', help = "Statistic of the data requests", default = "raw")
+    parser.add_argument ('--latency-ms', help = "Delay of every fake Prometheus response", type = float, default = 0.0)
+    parser.add_argument ('--iterations', help = "Requests per workload", type = int, default = 20)
+    parser.add_argument ('--concurrency', help = "Concurrent requests per workload", type = int, default = 4)
+    parser.add_argument ('--workloads', help = "Workloads to run", nargs = "+", choices = WORKLOADS, default = list (WORKLOADS))
+    parser.add_argument ('--no-cache', help = "Disable the range query cache", action = "store_true")
+    parser.add_argument ('--json', help = "Write the results to this file as JSON")
+    args = parser.parse_args ()
+
+    sys.path.insert (0, REPO)
+    from proxy.app import create_app
+
+    port = free_port ()
+    prometheus = start_fake_prometheus (port, args.objects, args.latency_ms)
+    directory = tempfile.mkdtemp (prefix = "portal-benchmarks-")
+    try:
+        overrides = {"cache_max_points": 0} if args.no_cache else {}
+        files = write_models (directory, args.objects, port, overrides)
+
+        started = time.perf_counter ()
+        app = create_app (**files)
+        startup_seconds = time.perf_counter () - started
+
+        results = {"startup_seconds": startup_seconds, "workloads": {}}
+        print ("create_app: %.3fs with %d objects" % (startup_seconds, args.objects))
+        print ("%-14s %9s %10s %10s %10s" % ("workload", "requests", "req/s", "p50 ms", "p99 ms"))
+        for name in args.workloads:
+            result = run_workload (app, workload_requests (name, args), args.iterations, args.concurrency)
+            results ["workloads"][name] = result
+            print ("%-14s %9d %10.1f %10.2f %10.2f" % (name, result ["requests"], result ["throughput"],
+                result ["p50_ms"], result ["p99_ms"]))
+
+        results ["peak_rss_mb"] = peak_rss_mb ()
+        print ("peak RSS: %.1f MB" % (results ["peak_rss_mb"]))
+
+        if args.json:
+            with open (args.json, "w") as f:
+                json.dump (results, f, indent = 2)
+    finally:
+        prometheus.terminate ()
+        prometheus.wait ()
+        shutil.rmtree (directory, ignore_errors = True)
+
+if __name__ == "__main__":
+    main ()
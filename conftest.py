@@ -0,0 +1,6 @@
+# The repository root is itself a package (it has an __init__.py), so pytest would put its parent directory on
+# sys.path; put the root there instead, so the tests import portal, prometheus and proxy as the app does
+import os
+import sys
+
+sys.path.insert (0, os.path.dirname (os.path.abspath (__file__)))
@@ -0,0 +1,190 @@
+"""
+    Serialization of the Portal Models straight to JSON text.
+
+    The field layout of each Model class, with its keys already encoded, is worked out once and
+    then reused for every instance, instead of building an attributes dictionary per object and
+    handing it back to the json module. The output is byte-identical to encoding the Models with
+    the json module through their attributes, with the same sort_keys and ensure_ascii settings
+    and compact separators.
+
+    Data point values that are not finite (Prometheus' "NaN", "+Inf" and "-Inf" samples) have no
+    JSON spelling, so they are written as null.
+"""
+
+import json
+from json.encoder import encode_basestring, encode_basestring_ascii
+
+from portal.objects import BaseObject, DataPointArray
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def attributes_default (obj):
+    if hasattr (obj, "attributes"):
+        return obj.attributes
+    raise TypeError ("Object of type %s is not JSON serializable" % (obj.__class__.__name__))
+
+def float_string (value):
+    # Same spelling of floats as the json module
+    if value != value:
+        return "NaN"
+    if value == float ("inf"):
+        return "Infinity"
+    if value == -float ("inf"):
+        return "-Infinity"
+    return float.__repr__ (value)
+
+def data_point_value_string (value):
+    # NaN and the infinities are not valid JSON, so a data point without a finite value is null
+    if value != value or value in (float ("inf"), -float ("inf")):
+        return "null"
+    return float.__repr__ (value)
+
+class PortalEncoder (object):
+    """
+        Encodes Portal Models, and lists and values containing them, to compact JSON.
+
+        sort_keys, ensure_ascii
+            As for json.dumps.
+
+        fallback
+            A json.JSONEncoder used for the values the encoder does not handle itself
+            (dictionaries and any other types). It defaults to one that encodes objects through
+            their attributes.
+
+        backend
+            "builtin", or "orjson" to hand the whole object to orjson when it is installed.
+            orjson is faster but not byte-identical: it writes any NaN or infinity as null,
+            and non-ASCII characters as UTF-8 even with ensure_ascii.
+    """
+
+    def __init__ (self, sort_keys = True, ensure_ascii = True, fallback = None, backend = "builtin"):
+        self.sort_keys = sort_keys
+        self.encode_string = encode_basestring_ascii if ensure_ascii else encode_basestring
+        if fallback is None:
+            fallback = json.JSONEncoder (sort_keys = sort_keys, ensure_ascii = ensure_ascii, separators = (",", ":"),
+                default = attributes_default)
+        self.fallback = fallback
+        self.backend = backend if (backend == "orjson" and orjson is not None) else "builtin"
+
+        self.layouts = {}
+        self.data_point_keys = tuple (self.encode_string (key) + ":" for key in ("timestamp", "value", "weight_value"))
+
+    def layout (self, cls):
+        # (attribute name, encoded '"name":' prefix) for each field of the class, in output order
+        layout = self.layouts.get (cls)
+        if layout is None:
+            fields = cls.fields ()
+            if self.sort_keys:
+                fields = sorted (fields)
+            layout = tuple ((name, self.encode_string (name) + ":") for name in fields)
+            self.layouts [cls] = layout
+        return layout
+
+    def encode (self, obj):
+        if self.backend == "orjson":
+            option = orjson.OPT_SORT_KEYS if self.sort_keys else 0
+            return orjson.dumps (obj, default = attributes_default, option = option).decode ("utf-8")
+
+        chunks = []
+        self.write (obj, chunks)
+        return "".join (chunks)
+
+    def iterencode (self, obj):
+        # Yields the JSON text one list element at a time, for a top level list or the list fields of a top level Model
+        if isinstance (obj, (list, tuple)):
+            for chunk in self.iterencode_list (obj):
+                yield chunk
+        elif isinstance (obj, BaseObject):
+            yield "{"
+            first = True
+            for name, key in self.layout (obj.__class__):
+                try:
+                    value = getattr (obj, name)
+                except AttributeError:
+                    continue
+                yield key if first else "," + key
+                first = False
+                if isinstance (value, list):
+                    for chunk in self.iterencode_list (value):
+                        yield chunk
+                else:
+                    yield self.encode (value)
+            yield "}"
+        else:
+            yield self.encode (obj)
+
+    def iterencode_list (self, items):
+        yield "["
+        first = True
+        for item in items:
+            yield self.encode (item) if first else "," + self.encode (item)
+            first = False
+        yield "]"
+
+    def write (self, obj, chunks):
+        append = chunks.append
+
+        if isinstance (obj, str):
+            append (self.encode_string (obj))
+        elif obj is None:
+            append ("null")
+        elif obj is True:
+            append ("true")
+        elif obj is False:
+            append ("false")
+        elif isinstance (obj, int):
+            append (int.__repr__ (obj))
+        elif isinstance (obj, float):
+            append (float_string (obj))
+        elif isinstance (obj, BaseObject):
+            self.write_object (obj, chunks)
+        elif isinstance (obj, (list, tuple)):
+            append ("[")
+            first = True
+            for item in obj:
+                if not first:
+                    append (",")
+                first = False
+                self.write (item, chunks)
+            append ("]")
+        elif isinstance (obj, DataPointArray):
+            self.write_data_points (obj, chunks)
+        else:
+            append (self.fallback.encode (obj))
+
+    def write_object (self, obj, chunks):
+        append = chunks.append
+
+        append ("{")
+        first = True
+        for name, key in self.layout (obj.__class__):
+            try:
+                value = getattr (obj, name)
+            except AttributeError:
+                continue
+            if not first:
+                append (",")
+            first = False
+            append (key)
+            self.write (value, chunks)
+        append ("}")
+
+    def write_data_points (self, data_points, chunks):
+        # Written straight from the columns, without a DataPoint or dictionary per sample; the keys are
+        # in the same order whether sorted or not
+        timestamp_key, value_key, weight_value_key = self.data_point_keys
+
+        append = chunks.append
+        append ("[")
+        for index in range (len (data_points)):
+            if index > 0:
+                append (",")
+            append ("{" + timestamp_key)
+            timestamp = data_points.timestamp (index)
+            append (int.__repr__ (timestamp) if isinstance (timestamp, int) else float_string (timestamp))
+            append ("," + value_key + data_point_value_string (data_points.values [index]))
+            append ("," + weight_value_key + data_point_value_string (data_points.weight_value (index)) + "}")
+        append ("]")
@@ -6,13 +6,32 @@
     defined as a set of key/value pairs.
 """
 
+import math
 import types
+from array import array
 
 class BaseObject (object):
     """
         Base class for Portal objects
     """
 
+    # Models declare their attributes in __slots__, so instances carry no __dict__
+    __slots__ = ()
+
+    # The attribute names of the Model, in declaration order, worked out once per class
+    @classmethod
+    def fields (cls):
+        fields = cls.__dict__.get ("_fields")
+        if fields is None:
+            fields = []
+            for klass in reversed (cls.__mro__):
+                for name in klass.__dict__.get ("__slots__", ()):
+                    if name not in fields:
+                        fields.append (name)
+            fields = tuple (fields)
+            cls._fields = fields
+        return fields
+
     # Set up a standard function that will return the specific Model dictionary that matches to the Portal JSON 
     @property
     def attributes (self):
@@ -20,7 +39,11 @@ class BaseObject (object):
         attrs = {}
 	
 	# loop through key/value pairs in the Class
-        for key, val in vars (self).items():
+        for key in self.fields ():
+            try:
+                val = getattr (self, key)
+            except AttributeError:
+                continue
             # if the value is a list, append each item to a list to be assigned to the key
             if isinstance (val, list):
                 l = []
@@ -88,6 +111,9 @@ class Granularity (BaseObject):
             granularities that are not global to the statistic.
     """
 
+    __slots__ = ("granularity_id", "value_seconds", "time_window_seconds", "display_name",
+                 "storage_duration", "description", "is_global")
+
     def __init__ (self, granularity_id, value_seconds, time_window_seconds,
                  display_name, storage_duration, description="", is_global=True):
 
@@ -144,6 +170,10 @@ class Metric (BaseObject):
             If Portal needs to summarize or aggregate time series data according to one of
             these rules, it will ask the data source to perform the calculation.
     """
+    __slots__ = ("metric_id", "unique_display_name", "unit", "suggested_aggregation_rule", "suggested_color",
+                 "stacked_area_weight", "applicable_statistic_ids", "inapplicable_statistic_ids",
+                 "provided_summary_rules")
+
     def __init__ (self, metric_id, unique_display_name, unit,
                  suggested_aggregation_rule = None, suggested_color = None,
                  stacked_area_weight = None, applicable_statistic_ids = None,
@@ -212,6 +242,11 @@ class ObjectType (BaseObject):
 
         limit_instances_configuration   LimitInstancesConfiguration
     """
+    __slots__ = ("id", "display_name", "root_type", "enumerable", "applicable_metrics",
+                 "scopable_object_types", "has_free_text_search", "has_data_source_provided_type_ahead",
+                 "has_ip_address_property", "pre_cache_instances", "include_parent_type_metrics", "cache_duration",
+                 "parent_type_metrics_intersection", "plural_display_name")
+
     def __init__ (self, id, display_name, root_type, enumerable, applicable_metrics = None,
                  scopable_object_types = None, has_free_text_search = True,
                  has_data_source_provided_type_ahead = False,
@@ -227,6 +262,7 @@ class ObjectType (BaseObject):
         self.applicable_metrics = [] if applicable_metrics is None else applicable_metrics
         self.scopable_object_types = [] if scopable_object_types is None else scopable_object_types
         self.has_free_text_search = has_free_text_search
+        self.has_data_source_provided_type_ahead = has_data_source_provided_type_ahead
         self.has_ip_address_property = has_ip_address_property
         self.pre_cache_instances = pre_cache_instances
         self.include_parent_type_metrics = include_parent_type_metrics
@@ -240,6 +276,8 @@ class ObjectType (BaseObject):
 
 ###
 class ScopableObjectTypes(BaseObject):
+    __slots__ = ()
+
     def __init__(self):
         pass
 
@@ -251,6 +289,8 @@ class LimitInstancesConfiguration(BaseObject):
             A unique identifier representing the metric that the top N search should use.
     """
 
+    __slots__ = ("nValue", "metric_id")
+
     def __init__(self, nValue, metric_id=""):
         self.nValue = nValue
         self.metric_id = metric_id
@@ -272,6 +312,8 @@ class ObjectDefinition(BaseObject):
         A list of portal_object_property
     """
 
+    __slots__ = ("object_id", "display_name", "object_type_id", "object_properties")
+
     def __init__ (self, object_id, display_name, object_type_id, object_properties = None):
         self.object_id = object_id
         self.display_name = display_name
@@ -296,6 +338,8 @@ class ObjectPropertyDefinition (BaseObject):
             Should the property value be escaped when using it for variable substitution?
     """
 
+    __slots__ = ("id", "display_name", "hidden", "url_pass_through")
+
     def __init__ (self, id, display_name, hidden=False,
                  url_pass_through=False):
         self.id = id
@@ -314,6 +358,8 @@ class ObjectProperty (BaseObject):
         value*	string
             The value of the property.
     """
+    __slots__ = ("id", "value")
+
     def __init__ (self, id, value):
         self.id = id
         self.value = value
@@ -333,6 +379,8 @@ class SearchResult (BaseObject):
             The object filters to specify the parent of the object in the
             case of a * * search.
     """
+    __slots__ = ("object", "value", "parent_object_filters")
+
     def __init__ (self, obj, value = None, parent_object_filters = None):
         self.object = obj
         self.value = value
@@ -363,6 +411,8 @@ class ScopableType (BaseObject):
             type. The default value is false but this is is not useful in most cases.
 
     """
+    __slots__ = ("object_type_id", "all_instances", "filter_object_instances", "top_n_wildcarding")
+
     def __init__ (self, object_type_id, all_instances,
                  filter_object_instances = True, top_n_wildcarding = False):
         self.object_type_id = object_type_id
@@ -385,12 +435,81 @@ class DataPoint (BaseObject):
             The weight value that should be associated with this data point
             when calculating average values.
     """
+    __slots__ = ("timestamp", "value", "weight_value")
+
     def __init__ (self, timestamp, value, weight_value = 1.0):
         self.timestamp = timestamp
         self.value = value
         self.weight_value = weight_value
 
 
+def finite_or_none (value):
+    # JSON has no NaN or infinity, so data points without a finite value are sent as null
+    return value if math.isfinite (value) else None
+
+
+class DataPointArray (object):
+    """
+        The data points of a metric/statistic pair, held as columns of doubles rather than as
+        one DataPoint per sample. Serializes to the same list of DataPoint dictionaries.
+
+        timestamps
+            The UTC +0 timestamps of the data points.
+
+        values
+            The values of the data points, NaN where there is no valid data point. Values that
+            are not finite are serialized as null, as JSON has no NaN or infinity.
+
+        weight_values
+            The weights of the data points, or None when every weight is 1.0.
+    """
+    __slots__ = ("timestamps", "values", "weight_values")
+
+    def __init__ (self, timestamps = None, values = None, weight_values = None):
+        self.timestamps = array ("d", [] if timestamps is None else timestamps)
+        self.values = array ("d", [] if values is None else values)
+        self.weight_values = None if weight_values is None else array ("d", weight_values)
+
+    @classmethod
+    def from_pairs (cls, pairs):
+        # Prometheus returns each sample as a [timestamp, "value"] pair
+        data_points = cls ()
+        data_points.timestamps.extend (pair [0] for pair in pairs)
+        data_points.values.extend (float (pair [1]) for pair in pairs)
+        return data_points
+
+    def timestamp (self, index):
+        # Integral timestamps are reported as integers, as Portal expects
+        timestamp = self.timestamps [index]
+        return int (timestamp) if timestamp.is_integer () else timestamp
+
+    def weight_value (self, index):
+        return 1.0 if self.weight_values is None else self.weight_values [index]
+
+    def __len__ (self):
+        return len (self.timestamps)
+
+    def __getitem__ (self, index):
+        return DataPoint (timestamp = self.timestamp (index), value = self.values [index], weight_value = self.weight_value (index))
+
+    def __iter__ (self):
+        for index in range (len (self.timestamps)):
+            yield self [index]
+
+    @property
+    def attributes (self):
+        # Dictionaries are only built while the response is encoded, never kept with the data
+        return [{"timestamp": self.timestamp (index), "value": finite_or_none (self.values [index]),
+                 "weight_value": finite_or_none (self.weight_value (index))}
+                for index in range (len (self.timestamps))]
+
+    def __str__ (self):
+        return "DataPointArray - %d data points\n" % (len (self))
+
+    def __repr__ (self):
+        return self.__str__()
+
+
 class MetricValue (BaseObject):
     """
         A set of time series data for an individual metric.
@@ -410,12 +529,15 @@ class MetricValue (BaseObject):
             The data points for the metric/statistic pair.
             Data_Point{...}
         ]
+            Either a list of DataPoint or a DataPointArray.
 
         last_valid_timestamp	integer($int64)
             A value to be passed and used as DCLDataFragment.setLastValidTimestamp().
             This can be used to control how the data in this response is cached by
             the proxy.
     """
+    __slots__ = ("metric_id", "statistic_id", "data_points", "summary_rule", "last_valid_timestamp")
+
     def __init__ (self, metric_id, statistic_id, data_points,
                  summary_rule = None, last_valid_timestamp = None):
         self.metric_id = metric_id
@@ -436,6 +558,8 @@ class DataResponse (BaseObject):
     metric_values
         An array of the metric values in for the request.
     """
+    __slots__ = ("data_request_id", "metric_values")
+
     def __init__ (self, data_request_id, metric_values):
         self.data_request_id = data_request_id
         self.metric_values = metric_values
@@ -456,6 +580,8 @@ class SearchResponse (BaseObject):
         search_error_string	string
             An error message explaining the reason for a search failure.            
     """
+    __slots__ = ("search_results", "valid_interval", "search_error_string")
+
     def __init__ (self, search_results = None, valid_interval = 300, search_error_string = None):
         self.search_results = [] if search_results is None else search_results
         self.valid_interval = valid_interval
@@ -532,6 +658,10 @@ class Statistic (BaseObject):
                 4:"lower_critical"
                 5:"status"
     """
+    __slots__ = ("id", "display_name", "is_global", "is_default", "is_rollup", "is_primary",
+                 "is_non_periodic", "is_status_data", "granularity_ids", "data_points_time_aligned",
+                 "suggested_aggregation_rule", "data_tags")
+
     def __init__ (self, id, display_name, is_global = True, is_default = False,
                  is_rollup = False, is_primary = False, is_non_periodic = False,
                  is_status_data = False, granularity_ids = None,
@@ -566,6 +696,8 @@ class SuggestedSummaryRule (BaseObject):
             3:"avg"
             4:"last_value"
     """
+    __slots__ = ("rule",)
+
     def __init__ (self, rule):
         self.rule = rule
 
@@ -643,6 +775,13 @@ class Preferences (BaseObject):
         strings the user types into the search bar will be sent to the data source via the type_ahead_search endpoint        
 
     """
+    __slots__ = ("update_object_cache_on_initial_sync", "object_cache_update_duration_seconds",
+                 "initial_object_cache_request_duration_seconds",
+                 "update_object_cache_request_duration_seconds", "data_request_batch_limit",
+                 "data_request_max_thread_count", "heartbeat_request_interval_seconds", "utc_offset",
+                 "management_web_url", "supports_object_specific_launches", "always_request_recent_data",
+                 "create_scoped_objects", "supports_type_ahead_searches")
+
     def __init__ (self, update_object_cache_on_initial_sync = True,
                  object_cache_update_duration_seconds = 7200,
                  initial_object_cache_request_duration_seconds = 2419200,
@@ -718,6 +857,9 @@ class LaunchURL (BaseObject):
             Description of this URL launch
 
     """
+    __slots__ = ("url_string", "valid_objects", "valid_metrics", "id", "display_name", "sub_menu",
+                 "description", "applies_to_all_scoped_types")
+
     def __init__ (self, url_string,  id,
                  display_name, description, sub_menu = None,
                  valid_objects = None, valid_metrics = None, 
@@ -733,6 +875,9 @@ class LaunchURL (BaseObject):
 
 class SoftwareVersion (BaseObject):
 
+    __slots__ = ("data_source_type", "major_version", "minor_version", "display_string", "revision_number",
+                 "build_number")
+
     def __init__ (self, data_source_type, major_version, minor_version,
                  display_string="", revision_number=0, build_number=0):
         self.data_source_type = data_source_type
@@ -743,6 +888,8 @@ class SoftwareVersion (BaseObject):
         self.build_number = build_number
 
 class ObjectFilter (BaseObject):
+    __slots__ = ("object_type_id", "instance_id")
+
     def __init__ (self, object_type_id, instance_id):
         self.object_type_id = object_type_id
         self.instance_id = instance_id
@@ -781,6 +928,9 @@ class AlertObject (BaseObject):
             Additional information about this alert.
     """
     
+    __slots__ = ("alert_id", "name", "start_time_seconds", "description", "duration_seconds", "value",
+                 "ongoing", "severity", "additional_info")
+
     def __init__ (self, alert_id, name, start_time_seconds,
                  description, duration_seconds, value,
                  ongoing, severity, additional_info=[]):
@@ -808,6 +958,8 @@ class AlertAdditionalInfo (BaseObject):
             {description: Specifies a property in the form of a JSON object}
     """
     
+    __slots__ = ("name", "type", "value")
+
     def __init__ (self, name, alert_type, value={}):
         self.name = name
         self.type = alert_type
@@ -0,0 +1,135 @@
+"""
+    Statistics of time series data per step bucket, computed with NumPy.
+
+    A metric is fetched once at a fine resolution, and each statistic is then computed from those
+    samples for every bucket of the requested granularity: the bucket of the data point at
+    timestamp t holds the samples in (t - step, t], like a PromQL <function>_over_time [step].
+    The weight_value of each data point is the number of samples it was computed from, and
+    buckets without samples get no data point.
+
+    Statistic functions are "raw", "avg", "min", "max", "sum", "count" and "p<percentile>", e.g.
+    "p95" or "p99.9". "raw" is the sample at each bucket's timestamp, as a range query at the
+    requested step returns it.
+"""
+
+import math
+from array import array
+
+import numpy
+
+from portal.objects import DataPointArray
+
+FUNCTIONS = ("raw", "avg", "min", "max", "sum", "count")
+
+def percentile (function):
+    # The percentile of a "p<percentile>" function, or None for any other function
+    if not function.startswith ("p"):
+        return None
+    try:
+        q = float (function [1:])
+    except ValueError:
+        return None
+    return q if 0 <= q <= 100 else None
+
+def is_function (function):
+    return function in FUNCTIONS or percentile (function) is not None
+
+def statistic_functions (statistics):
+    """
+        Maps the id of each statistic of the statistics model to its function: the function
+        key of the statistic, or its id. Statistics with an unknown function are served as raw.
+    """
+    functions = {}
+    for statistic in statistics:
+        function = str (statistic.get ("function", statistic ["id"]))
+        functions [statistic ["id"]] = function if is_function (function) else "raw"
+
+    return functions
+
+def resolution (start_time, end_time, step, native_step, max_points):
+    """
+        The fine step to fetch for statistics at step: the smallest divisor of step that is at
+        least native_step and needs no more than max_points samples over the range.
+    """
+    if step <= native_step:
+        return step
+
+    points = max (end_time - start_time + step, 0)
+    divisors = set ()
+    for d in range (1, int (math.isqrt (step)) + 1):
+        if step % d == 0:
+            divisors.update ((d, step // d))
+
+    for d in sorted (divisors):
+        if d >= native_step and points // d <= max_points:
+            return d
+
+    return step
+
+def columns (pairs):
+    # [timestamp, "value"] pairs to timestamp and value arrays, converting the value strings in bulk
+    if not pairs:
+        return numpy.empty (0), numpy.empty (0)
+
+    timestamps = numpy.fromiter ((pair [0] for pair in pairs), dtype = numpy.float64, count = len (pairs))
+    values = numpy.array ([pair [1] for pair in pairs]).astype (numpy.float64)
+    return timestamps, values
+
+def data_point_array (timestamps, values, weight_values = None):
+    # Copied into the columns as raw doubles, not one float object at a time
+    data_points = DataPointArray ()
+    data_points.timestamps.frombytes (numpy.ascontiguousarray (timestamps, dtype = numpy.float64).tobytes ())
+    data_points.values.frombytes (numpy.ascontiguousarray (values, dtype = numpy.float64).tobytes ())
+    if weight_values is not None:
+        data_points.weight_values = array ("d")
+        data_points.weight_values.frombytes (numpy.ascontiguousarray (weight_values, dtype = numpy.float64).tobytes ())
+    return data_points
+
+def summarize (pairs, function, start_time, end_time, step):
+    """
+        The data points of function over the samples in pairs, one per step from start_time to
+        end_time. pairs are the samples of one series in time order, as Prometheus returns them,
+        and must reach back to start_time - step for the first bucket to be complete.
+    """
+    timestamps, values = columns (pairs)
+
+    # Bucket k has its data point at start_time + k * step
+    buckets = numpy.ceil ((timestamps - start_time) / step)
+    last = (end_time - start_time) // step
+    keep = (buckets >= 0) & (buckets <= last)
+
+    if function == "raw":
+        # NaN and infinite samples are kept, as the raw data points of a range query are, and sent as null
+        keep &= (timestamps - start_time) % step == 0
+        return data_point_array (timestamps [keep], values [keep])
+
+    keep &= ~numpy.isnan (values)
+    buckets = buckets [keep].astype (numpy.int64)
+    values = values [keep]
+    if len (values) == 0:
+        return DataPointArray ()
+
+    # Samples are in time order, so each bucket is a contiguous run of them
+    bucket_ids, first, counts = numpy.unique (buckets, return_index = True, return_counts = True)
+    bucket_timestamps = start_time + bucket_ids * float (step)
+    weights = counts.astype (numpy.float64)
+
+    if function == "avg":
+        result = numpy.add.reduceat (values, first) / counts
+    elif function == "min":
+        result = numpy.minimum.reduceat (values, first)
+    elif function == "max":
+        result = numpy.maximum.reduceat (values, first)
+    elif function == "sum":
+        result = numpy.add.reduceat (values, first)
+    elif function == "count":
+        result = weights
+    else:
+        # Sort the samples within each bucket, then interpolate linearly between the closest ranks
+        values = values [numpy.lexsort ((values, buckets))]
+        position = first + (counts - 1) * (percentile (function) / 100.0)
+        lower = numpy.floor (position).astype (numpy.int64)
+        upper = numpy.ceil (position).astype (numpy.int64)
+        result = values [lower] + (values [upper] - values [lower]) * (position - lower)
+
+    return data_point_array (bucket_timestamps, result, weights)
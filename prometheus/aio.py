@@ -0,0 +1,232 @@
+"""
+    Asynchronous queries to Prometheus, for the ASGI serving mode of proxy/asgi.py.
+
+    AsyncPrometheusClient keeps any number of queries outstanding on the event loop over aiohttp,
+    rather than blocking a thread per query. The query helpers mirror those of prometheus.api,
+    with the same range cache, sharding and coalescing of identical queries.
+"""
+
+import asyncio
+import json
+import time
+
+from prometheus.api import merge_shards, matrix_series, query_path, range_shards, target_get
+from prometheus.callbacks import backend, batch_responses, merge_values, plan_batch, value_queries
+from proxy.timing import phase
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+RETRY_STATUS = (502, 503, 504)
+
+class AsyncSingleFlight (object):
+    """
+        SingleFlight for coroutines: concurrent callers asking for the same key on the event loop
+        share one call, and its result or exception.
+    """
+
+    def __init__ (self):
+        self.calls = {}
+        self.counters = {"calls": 0, "coalesced": 0}
+
+    async def do (self, key, function):
+        task = self.calls.get (key)
+        if task is None:
+            task = asyncio.ensure_future (function ())
+            self.calls [key] = task
+            task.add_done_callback (lambda task: self.calls.pop (key, None))
+            self.counters ["calls"] += 1
+        else:
+            self.counters ["coalesced"] += 1
+
+        # Shielded, so a caller that is cancelled does not cancel the call for the others
+        return await asyncio.shield (task)
+
+    def stats (self):
+        stats = dict (self.counters)
+
+        requested = stats ["calls"] + stats ["coalesced"]
+        stats ["coalescing_ratio"] = stats ["coalesced"] / requested if requested > 0 else 0.0
+
+        return stats
+
+class AsyncPrometheusClient (object):
+    """
+        Connection to a Prometheus server for coroutines running on one event loop.
+
+        max_in_flight bounds the queries outstanding against the target, and the connections
+        opened to it. Connection failures and 502/503/504 responses are retried with exponential
+        backoff. cache, coalesce, shard_points and metrics are as for PrometheusClient; a RangeCache
+        may be shared with the PrometheusClient of the same target.
+
+        Requires aiohttp. The session is opened on the event loop of the first query.
+    """
+
+    def __init__ (self, hostname, port, retries = 3, backoff_factor = 0.5, timeout = 60, max_in_flight = 1000,
+                 cache = None, coalesce = True, shard_points = 0, metrics = None):
+        if aiohttp is None:
+            raise RuntimeError ("The asynchronous Prometheus client needs aiohttp")
+
+        self.target = target_get (hostname, port)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.cache = cache
+        self.single_flight = AsyncSingleFlight () if coalesce else None
+        self.shard_points = shard_points
+        self.metrics = metrics
+
+        self.session = None
+        self.in_flight = None
+        self.counters = {"requests": 0, "errors": 0, "in_flight": 0}
+
+    @classmethod
+    def from_client (cls, client, max_in_flight = 1000):
+        # The same target and options as a PrometheusClient, sharing its range cache
+        retry = client.adapter.max_retries
+        return cls (client.target, -1, retries = retry.total, backoff_factor = retry.backoff_factor,
+            timeout = client.timeout, max_in_flight = max_in_flight, cache = client.cache,
+            coalesce = client.single_flight is not None, shard_points = client.shard_points, metrics = client.metrics)
+
+    def open (self):
+        if self.session is None:
+            self.in_flight = asyncio.Semaphore (self.max_in_flight)
+            self.session = aiohttp.ClientSession (connector = aiohttp.TCPConnector (limit = self.max_in_flight, ssl = False))
+        return self.session
+
+    async def post (self, path, data, timeout = None):
+        request = lambda: self.request ("POST", path, data = data, timeout = timeout)
+
+        if self.single_flight is None:
+            return await request ()
+
+        return await self.single_flight.do ((path, tuple (sorted (data.items ()))), request)
+
+    async def get (self, path, params = None, timeout = None):
+        return await self.request ("GET", path, params = params, timeout = timeout)
+
+    async def request (self, method, path, timeout = None, **kwargs):
+        session = self.open ()
+        url = "http://" + self.target + path
+        client_timeout = aiohttp.ClientTimeout (total = self.timeout if timeout is None else timeout)
+
+        self.counters ["requests"] += 1
+        async with self.in_flight:
+            self.counters ["in_flight"] += 1
+            start = time.perf_counter ()
+            try:
+                attempt = 0
+                while True:
+                    try:
+                        async with session.request (method, url, timeout = client_timeout, **kwargs) as r:
+                            if r.status not in RETRY_STATUS or attempt >= self.retries:
+                                return json.loads (await r.read ())
+                    except aiohttp.ClientConnectionError:
+                        if attempt >= self.retries:
+                            raise
+
+                    await asyncio.sleep (self.backoff_factor * (2 ** attempt))
+                    attempt += 1
+            except Exception:
+                self.counters ["errors"] += 1
+                if self.metrics is not None:
+                    self.metrics.errors.inc (1, "backend", self.target)
+                raise
+            finally:
+                self.counters ["in_flight"] -= 1
+                if self.metrics is not None:
+                    self.metrics.backend_seconds.observe (time.perf_counter () - start, self.target, query_path (path))
+
+    def stats (self):
+        stats = dict (self.counters)
+
+        if self.cache is not None:
+            stats ["cache"] = self.cache.stats ()
+
+        if self.single_flight is not None:
+            stats ["single_flight"] = self.single_flight.stats ()
+
+        return stats
+
+    async def close (self):
+        if self.session is not None:
+            await self.session.close ()
+            self.session = None
+
+async def time_range_query (client, query_string, start_time, end_time, step, timeout = None):
+    data = {"query": query_string, "start": str (start_time), "end": str (end_time), "step": str (step)}
+
+    return await client.post ("/api/v1/query_range", data, timeout)
+
+async def fetch_shard_series (client, query_string, start_time, end_time, step, timeout = None):
+
+    result = await time_range_query (client, query_string, start_time, end_time, step, timeout)
+
+    return matrix_series (result)
+
+async def fetch_range_series (client, query_string, start_time, end_time, step, timeout = None):
+
+    shards = range_shards (start_time, end_time, step, client.shard_points)
+    if len (shards) == 1:
+        return await fetch_shard_series (client, query_string, start_time, end_time, step, timeout)
+
+    return merge_shards (await asyncio.gather (*[fetch_shard_series (client, query_string, shard_start, shard_end, step, timeout)
+                                                for shard_start, shard_end in shards]))
+
+async def time_range_series (client, query_string, start_time, end_time, step, timeout = None):
+
+    cache = client.cache
+    if cache is None or not cache.cacheable (start_time, end_time, step):
+        return await fetch_range_series (client, query_string, start_time, end_time, step, timeout)
+
+    # As RangeCache.time_range_series, with the missing runs fetched concurrently
+    chunks, runs = cache.lookup (query_string, start_time, end_time, step)
+    fetched = await asyncio.gather (*[fetch_range_series (client, query_string, run_start, run_end, step, timeout)
+                                      for run_start, run_end in runs])
+
+    for (run_start, run_end), series_list in zip (runs, fetched):
+        if series_list is None:
+            return None
+        cache.store (query_string, step, run_start, run_end, series_list, chunks)
+
+    return cache.stitch (chunks, start_time, end_time)
+
+def async_client (app, b):
+    # Created on first use from the event loop thread, one per backend
+    clients = app.config.setdefault ("async_clients", {})
+    if b.name not in clients:
+        clients [b.name] = AsyncPrometheusClient.from_client (b.client,
+            max_in_flight = app.config ["systems"].get ("async_max_in_flight", 1000))
+
+    return clients [b.name]
+
+async def fetch_values (app, group, ids_by_metric_type, start_time, end_time, step):
+    queries = value_queries (group, ids_by_metric_type)
+    results = await asyncio.gather (*[time_range_series (async_client (app, b), query_string, start_time, end_time, step)
+                                      for metric_id, object_type_id, b, query_string in queries], return_exceptions = True)
+
+    return merge_values (queries, results)
+
+async def time_series_batch_async (app, data_requests, suggested_summary_rule, start_time, end_time, step):
+    """
+        time_series_batch for the ASGI mode: the same plan and responses, with every query of the
+        batch in flight on the event loop at once.
+    """
+    group = backend (app)
+
+    plans, functions, summarized, fetches = plan_batch (app, data_requests, start_time, end_time, step)
+
+    values = {}
+    with phase ("backend"):
+        for ids_by_metric_type, fetch_start_time, fetch_end_time, fetch_step in fetches:
+            values.update (await fetch_values (app, group, ids_by_metric_type, fetch_start_time, fetch_end_time, fetch_step))
+
+    return list (batch_responses (app, plans, functions, summarized, values, suggested_summary_rule, start_time, end_time, step))
+
+async def shutdown_async (app):
+    # Closes the sessions of the asynchronous clients when the ASGI server shuts down
+    for client in app.config.get ("async_clients", {}).values ():
+        await client.close ()
@@ -1,10 +1,13 @@
 import argparse
-import argparse
 import json
 import requests
 import socket
+import threading
 import time
 import yaml
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 PROMETHEUS_SERVER_TIMEOUT = 3
 PROMETHEUS_SERVER_RETRY = 3
@@ -45,43 +48,341 @@ def target_get (hostname, port):
 
     return target
 
-def time_range_query (hostname, port, query_string, start_time, end_time, step, timeout):
-        target = target_get (hostname, port)
-        url = "http://" + target + "/api/v1/query_range?query=" + query_string + \
-            "&start=" + str (start_time) + "&end=" + str(end_time) + "&step=" + str (step)
+class SingleFlight (object):
+    """
+        Lets concurrent callers asking for the same key share one call: the first caller runs it,
+        the others wait for it and get the same result, or the same exception. Callers must not
+        modify a shared result.
+    """
+
+    class Call (object):
+        def __init__ (self):
+            self.done = threading.Event ()
+            self.result = None
+            self.error = None
+
+    def __init__ (self):
+        self.lock = threading.Lock ()
+        self.calls = {}
+        self.counters = {"calls": 0, "coalesced": 0}
+
+    def do (self, key, function):
+        with self.lock:
+            call = self.calls.get (key)
+            leader = call is None
+            if leader:
+                call = SingleFlight.Call ()
+                self.calls [key] = call
+                self.counters ["calls"] += 1
+            else:
+                self.counters ["coalesced"] += 1
+
+        if not leader:
+            call.done.wait ()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function ()
+        except BaseException as error:
+            # Any exception, so the waiters never take a missing result for a None one
+            call.error = error
+            raise
+        finally:
+            # Callers arriving from now on start a new call, so they never see a stale result
+            with self.lock:
+                del self.calls [key]
+            call.done.set ()
+
+        return call.result
+
+    def stats (self):
+        with self.lock:
+            stats = dict (self.counters)
+
+        requested = stats ["calls"] + stats ["coalesced"]
+        stats ["coalescing_ratio"] = stats ["coalesced"] / requested if requested > 0 else 0.0
+
+        return stats
+
+class PrometheusClient (object):
+    """
+        Shared connection to a Prometheus server, safe to use from every request thread.
+
+        All queries go through one requests.Session, so connections are kept alive and reused
+        between queries instead of paying a TCP/TLS handshake each time. pool_maxsize caps the
+        sockets opened to the target; with pool_block set, extra queries wait for a free
+        connection rather than opening more. Connection failures and 502/503/504 responses are
+        retried with exponential backoff.
+
+        max_in_flight bounds the queries outstanding against the target across all request
+        threads. Queries are run concurrently on the pool of the BackendGroup the client is part
+        of; the client itself only runs the shards of a query in parallel.
+
+        cache is an optional RangeCache that time_range_series serves range queries from.
+
+        With coalesce set, identical queries that are in flight at the same time share a single
+        call to the target.
+
+        Range queries of more than shard_points evaluation steps are split into step-aligned
+        shards of at most that many steps, fetched in parallel and merged; 0 disables sharding.
+
+        metrics is an optional ProxyMetrics that the duration and errors of each query go to.
+    """
+
+    def __init__ (self, hostname, port, pool_connections = 1, pool_maxsize = 10, pool_block = True,
+                 retries = PROMETHEUS_SERVER_RETRY, backoff_factor = 0.5, timeout = 60, max_in_flight = None,
+                 cache = None, coalesce = True, shard_points = 0, metrics = None):
+        self.target = target_get (hostname, port)
+        self.metrics = metrics
+        self.timeout = timeout
+        self.cache = cache
+        self.single_flight = SingleFlight () if coalesce else None
+
+        self.max_in_flight = pool_maxsize if max_in_flight is None else max_in_flight
+        self.in_flight = threading.BoundedSemaphore (self.max_in_flight)
+
+        # Shards get a pool of their own, as they are submitted from queries already running on the pool
+        # of the BackendGroup, which must never wait on work queued behind them
+        self.shard_points = shard_points
+        self.shard_executor = ThreadPoolExecutor (max_workers = self.max_in_flight)
+
+        retry_options = {"total": retries, "backoff_factor": backoff_factor, "status_forcelist": (502, 503, 504),
+                         "raise_on_status": False}
+        # Queries are read-only, so POSTs are as safe to retry as GETs
+        try:
+            retry = Retry (allowed_methods = frozenset (["GET", "POST"]), **retry_options)
+        except TypeError:
+            retry = Retry (method_whitelist = frozenset (["GET", "POST"]), **retry_options)
+
+        self.adapter = HTTPAdapter (pool_connections = pool_connections, pool_maxsize = pool_maxsize,
+            max_retries = retry, pool_block = pool_block)
+
+        self.session = requests.Session ()
+        self.session.verify = False
+        self.session.mount ("http://", self.adapter)
+        self.session.mount ("https://", self.adapter)
+
+        self.lock = threading.Lock ()
+        self.counters = {"requests": 0, "errors": 0, "in_flight": 0}
+
+    def count (self, name, increment = 1):
+        with self.lock:
+            self.counters [name] += increment
+
+    def post (self, path, data, timeout = None):
         headers = {"Content-Type" : "application/x-www-form-urlencoded"}
+        request = lambda: self.request ("POST", path, data = data, headers = headers, timeout = timeout)
 
-        r = requests.post (url, headers = headers, verify = False, timeout = timeout)
+        if self.single_flight is None:
+            return request ()
 
-        result = json.loads (r.content)
+        return self.single_flight.do ((path, tuple (sorted (data.items ()))), request)
 
-        return result
-       
-def time_range_values (hostname, port, query_string, start_time, end_time, step, timeout = 60, top = True):
+    def get (self, path, params = None, timeout = None):
+        return self.request ("GET", path, params = params, timeout = timeout)
 
-    result = time_range_query (hostname, port, query_string, start_time, end_time, step, timeout)
-    
+    def request (self, method, path, timeout = None, **kwargs):
+        url = "http://" + self.target + path
+
+        self.count ("requests")
+        with self.in_flight:
+            self.count ("in_flight")
+            start = time.perf_counter ()
+            try:
+                r = self.session.request (method, url, timeout = self.timeout if timeout is None else timeout, **kwargs)
+                return json.loads (r.content)
+            except Exception:
+                self.count ("errors")
+                if self.metrics is not None:
+                    self.metrics.errors.inc (1, "backend", self.target)
+                raise
+            finally:
+                self.count ("in_flight", -1)
+                if self.metrics is not None:
+                    self.metrics.backend_seconds.observe (time.perf_counter () - start, self.target, query_path (path))
+
+    def stats (self):
+        with self.lock:
+            stats = dict (self.counters)
+
+        # Per host connection pool usage, as tracked by urllib3
+        pools = {}
+        poolmanager = self.adapter.poolmanager
+        for key in list (poolmanager.pools.keys ()):
+            pool = poolmanager.pools.get (key)
+            if pool is None:
+                continue
+            pools [pool.host + ":" + str (pool.port)] = {"connections_opened": pool.num_connections,
+                                                        "requests": pool.num_requests,
+                                                        "idle_connections": pool.pool.qsize () if pool.pool is not None else 0}
+        stats ["pools"] = pools
+
+        if self.cache is not None:
+            stats ["cache"] = self.cache.stats ()
+
+        if self.single_flight is not None:
+            stats ["single_flight"] = self.single_flight.stats ()
+
+        return stats
+
+    def close (self):
+        self.shard_executor.shutdown (wait = False)
+        self.session.close ()
+
+def query_path (path):
+    # The API endpoint of a path, e.g. "query_range", or "label" for every label values path
+    parts = path.split ("/")
+    return parts [3] if len (parts) > 3 else path
+
+def label_value_escape (value):
+    # Escape a label value for use inside a double-quoted PromQL string
+    return str (value).replace ("\\", "\\\\").replace ("\"", "\\\"").replace ("\n", "\\n")
+
+def regex_escape (value):
+    # Escape the RE2 metacharacters so an object id only ever matches itself
+    return "".join (("\\" + c) if c in "\\.+*?()|[]{}^$" else c for c in str (value))
+
+def label_matcher (label, values):
+    # A single value uses an exact matcher, several values share one (implicitly anchored) regex matcher
+    values = list (values)
+    if len (values) == 1:
+        return label + "=\"" + label_value_escape (values [0]) + "\""
+
+    return label + "=~\"" + label_value_escape ("|".join (regex_escape (v) for v in values)) + "\""
+
+def time_range_query (client, query_string, start_time, end_time, step, timeout = None):
+    # Send the parameters form encoded, so long label regexes are neither truncated nor mangled in the URL
+    data = {"query": query_string, "start": str (start_time), "end": str (end_time), "step": str (step)}
+
+    return client.post ("/api/v1/query_range", data, timeout)
+
+def instant_query (client, query_string, time, timeout = None):
+    data = {"query": query_string, "time": str (time)}
+
+    return client.post ("/api/v1/query", data, timeout)
+
+def instant_vector (client, query_string, time, timeout = None):
+
+    result = instant_query (client, query_string, time, timeout)
+
+    # Return every sample of a vector result, each with its "metric" labels and a single "value"
     if result ["status"] == "success":
         data = result ["data"]
+        if (data ["resultType"] == "vector"):
+            return data ["result"]
+
+    return None
+
+def label_values (client, label, start_time = None, end_time = None, timeout = None):
+    # The values of a label, optionally only those of series present between start_time and end_time
+    params = {}
+    if start_time is not None:
+        params ["start"] = str (start_time)
+    if end_time is not None:
+        params ["end"] = str (end_time)
+
+    result = client.get ("/api/v1/label/" + label + "/values", params, timeout)
+
+    if result ["status"] == "success":
+        return result ["data"]
+
+    return None
+
+def time_range_series (client, query_string, start_time, end_time, step, timeout = None):
+
+    if client.cache is not None:
+        fetch = lambda query_string, start_time, end_time, step: \
+            fetch_range_series (client, query_string, start_time, end_time, step, timeout)
+        return client.cache.time_range_series (fetch, query_string, start_time, end_time, step)
+
+    return fetch_range_series (client, query_string, start_time, end_time, step, timeout)
+
+def range_shards (start_time, end_time, step, shard_points):
+    # Step-aligned (start, end) sub-ranges of at most shard_points evaluation steps; consecutive shards
+    # neither overlap nor leave a gap, so no boundary point is fetched twice or missed
+    if shard_points <= 0 or not all (isinstance (t, int) for t in (start_time, end_time, step)) or step <= 0:
+        return [(start_time, end_time)]
+
+    shards = []
+    shard_start = start_time
+    while shard_start <= end_time:
+        shard_end = min (shard_start + (shard_points - 1) * step, end_time)
+        shards.append ((shard_start, shard_end))
+        shard_start = shard_end + step
+
+    return shards if shards else [(start_time, end_time)]
+
+def fetch_range_series (client, query_string, start_time, end_time, step, timeout = None):
+
+    shards = range_shards (start_time, end_time, step, client.shard_points)
+    if len (shards) == 1:
+        return fetch_shard_series (client, query_string, start_time, end_time, step, timeout)
+
+    futures = [client.shard_executor.submit (fetch_shard_series, client, query_string, shard_start, shard_end, step, timeout)
+               for shard_start, shard_end in shards]
+
+    return merge_shards ([future.result () for future in futures])
+
+def merge_series (parts):
+    """
+        Merges (metric, values) parts of series, given in time order, into one series per label
+        set, as a matrix result lists them.
+    """
+    merged = {}
+    for metric, values in parts:
+        labels = tuple (sorted (metric.items ()))
+        if labels not in merged:
+            merged [labels] = {"metric": metric, "values": []}
+        merged [labels]["values"].extend (values)
+
+    # Keep the label set ordering that Prometheus uses for a matrix
+    return [merged [labels] for labels in sorted (merged)]
+
+def merge_shards (shard_series):
+    # Merge the series lists of the shards, in time order, into one series per label set; a failed shard
+    # fails the whole query
+    if any (series_list is None for series_list in shard_series):
+        return None
+
+    return merge_series ((series ["metric"], series ["values"]) for series_list in shard_series for series in series_list)
+
+def matrix_series (result):
+    # Return every series of a matrix result, each with its "metric" labels and "values"
+    if result ["status"] == "success":
+        data = result ["data"]
+        if (data ["resultType"] == "matrix"):
+            return data ["result"]
+
+    return None
+
+def fetch_shard_series (client, query_string, start_time, end_time, step, timeout = None):
+
+    result = time_range_query (client, query_string, start_time, end_time, step, timeout)
+
+    return matrix_series (result)
+       
+def time_range_values (client, query_string, start_time, end_time, step, timeout = None, top = True):
+
+    metric_values_list = time_range_series (client, query_string, start_time, end_time, step, timeout)
+    
+    if metric_values_list is not None:
         if top == True:
             top_value = 0
         
         # handle matrix data return
-        if (data ["resultType"] == "matrix"):
-            metric_values_list = data ["result"]
-            for metric_values in metric_values_list:
-                values = metric_values ["values"]
-
-                if top == True:
-                    for value in values:
-                        value_to_compare = float (value [1])
-                        if (value_to_compare > top_value):
-                            top_value = value_to_compare
-                    return top_value
-                else:
-                    return values
-        else:
-            return None
+        for metric_values in metric_values_list:
+            values = metric_values ["values"]
+
+            if top == True:
+                for value in values:
+                    value_to_compare = float (value [1])
+                    if (value_to_compare > top_value):
+                        top_value = value_to_compare
+                return top_value
+            else:
+                return values
     else:
         return None
 
@@ -89,11 +390,17 @@ def time_range_values (hostname, port, query_string, start_time, end_time, step,
 def main ():
     parser = argparse.ArgumentParser (description="Prometheus Server class functional test")
     parser.add_argument ('--hostname', help = "Prometheus hostname")
-    parser.add_argument ('--port', help = "Prometheus port")
+    parser.add_argument ('--port', help = "Prometheus port", type = int, default = 9090)
+    parser.add_argument ('--query', help = "PromQL range query", default = "up")
+    parser.add_argument ('--seconds', help = "Range queried, ending now", type = int, default = 86400)
+    parser.add_argument ('--step', help = "Query resolution in seconds", type = int, default = 3600)
     args = parser.parse_args ()
 
-    result = time_series_query ("up", "2019-05-01T20:10:51.781Z", "2019-05-02T20:10:51.781Z", "1h", 120)
-    print (result)
+    client = PrometheusClient (args.hostname, args.port)
+    end_time = int (time.time ())
+    result = time_range_series (client, args.query, end_time - args.seconds, end_time, args.step)
+    print (json.dumps (result, indent = 2))
+    client.close ()
 
 # Test function
 if __name__ == "__main__":
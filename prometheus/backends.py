@@ -0,0 +1,101 @@
+"""
+    Several Prometheus targets behind one proxy: queries are routed to the targets that hold
+    the objects asked for, run on all of them in parallel, and their results merged.
+"""
+
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger (__name__)
+
+class Backend (object):
+    """
+        One target of a BackendGroup.
+
+        name
+            Used in the logs and in the backend status.
+
+        client
+            PrometheusClient of the target.
+
+        routes
+            Optional dictionary of object type id to a regular expression. For those object types,
+            the target only serves the object ids the expression matches in full; for any other
+            object type it serves every object.
+    """
+
+    def __init__ (self, name, client, routes = None):
+        self.name = name
+        self.client = client
+        self.routes = dict ((object_type_id, re.compile (pattern)) for object_type_id, pattern in (routes or {}).items ())
+
+    def serves (self, object_type_id, object_id):
+        pattern = self.routes.get (object_type_id)
+        return pattern is None or pattern.fullmatch (str (object_id)) is not None
+
+class BackendGroup (object):
+    """
+        The Prometheus targets of the proxy, queried in parallel.
+
+        partition () splits the object ids of a query between the targets that serve them;
+        fan_out () runs a query against every target. A target that fails is logged and left
+        out of the merged result, so one target being down only hides its own objects.
+    """
+
+    def __init__ (self, backends):
+        self.backends = list (backends)
+
+        # Queries per target are already bounded by each client, so the pool only needs to be able to run them all
+        self.executor = ThreadPoolExecutor (max_workers = max (sum (b.client.max_in_flight for b in self.backends), 1))
+
+    def partition (self, object_type_id, object_ids):
+        # [(backend, object ids)] for each backend serving at least one of the objects
+        parts = []
+        for b in self.backends:
+            if object_type_id in b.routes:
+                ids = [object_id for object_id in object_ids if b.serves (object_type_id, object_id)]
+            else:
+                ids = list (object_ids)
+            if ids:
+                parts.append ((b, ids))
+
+        return parts
+
+    def submit (self, function, *args, **kwargs):
+        # Runs a query on the pool shared by the queries to every target. Work submitted here must not submit
+        # further work to it, so the pool can never deadlock on itself; shards go to each client's own pool
+        return self.executor.submit (function, *args, **kwargs)
+
+    def fan_out (self, function, *args, **kwargs):
+        """
+            Runs function (client, *args, **kwargs) against every target in parallel and returns
+            (backend, result) for those that succeeded, in target order. Raises the first error if
+            every target failed.
+        """
+        futures = [(b, self.submit (function, b.client, *args, **kwargs)) for b in self.backends]
+
+        results = []
+        errors = []
+        for b, future in futures:
+            try:
+                results.append ((b, future.result ()))
+            except Exception as error:
+                logger.warning ("Query to backend %s failed: %s", b.name, error)
+                errors.append (error)
+
+        if errors and not results:
+            raise errors [0]
+
+        return results
+
+    def stats (self):
+        if len (self.backends) == 1:
+            return self.backends [0].client.stats ()
+
+        return {"backends": dict ((b.name, b.client.stats ()) for b in self.backends)}
+
+    def close (self):
+        self.executor.shutdown (wait = False)
+        for b in self.backends:
+            b.client.close ()
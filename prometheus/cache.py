@@ -0,0 +1,140 @@
+import threading
+import time
+from collections import OrderedDict
+
+from prometheus.api import merge_series
+
+class RangeCache (object):
+    """
+        Cache of range query results, split into step-aligned chunks of chunk_points samples
+        and keyed by (query, step). A request is served from the cached chunks, and only the
+        missing chunks are fetched from the target, one range query per contiguous run.
+
+        Chunks ending within recent_seconds of now are never cached, so the tail of the data,
+        which may still change, is always fetched again. max_points bounds the memory used;
+        the least recently used chunks are evicted first.
+    """
+
+    def __init__ (self, max_points = 2000000, chunk_points = 240, recent_seconds = 300):
+        self.max_points = max_points
+        self.chunk_points = chunk_points
+        self.recent_seconds = recent_seconds
+
+        self.chunks = OrderedDict ()
+        self.points = 0
+        self.lock = threading.Lock ()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get (self, key):
+        with self.lock:
+            chunk = self.chunks.get (key)
+            if chunk is None:
+                self.counters ["misses"] += 1
+                return None
+
+            self.chunks.move_to_end (key)
+            self.counters ["hits"] += 1
+            return chunk
+
+    def put (self, key, chunk):
+        # Empty chunks are cached too, and count as one point so that they can be evicted
+        size = max (sum (len (values) for metric, values in chunk), 1)
+
+        with self.lock:
+            if key in self.chunks:
+                return
+
+            self.chunks [key] = chunk
+            self.points += size
+            while self.points > self.max_points and self.chunks:
+                evicted_key, evicted = self.chunks.popitem (last = False)
+                self.points -= max (sum (len (values) for metric, values in evicted), 1)
+                self.counters ["evictions"] += 1
+
+    def stats (self):
+        with self.lock:
+            stats = dict (self.counters)
+            stats ["chunks"] = len (self.chunks)
+            stats ["points"] = self.points
+
+        return stats
+
+    def cacheable (self, start_time, end_time, step):
+        return all (isinstance (t, int) for t in (start_time, end_time, step)) and step > 0 and end_time >= start_time
+
+    def lookup (self, query_string, start_time, end_time, step):
+        """
+            Returns (chunks, runs): the cached chunks of the request by index, and the
+            (start_time, end_time) of each contiguous run of missing chunks, to be fetched with a
+            single range query each and handed to store.
+        """
+        # Chunks are aligned to the evaluation timestamps of the request, start_time + k * step
+        span = step * self.chunk_points
+        phase = start_time % step
+        first = (start_time - phase) // span
+        last = (end_time - phase) // span
+
+        chunks = {}
+        missing = []
+        for index in range (first, last + 1):
+            chunk = self.get ((query_string, step, phase, index))
+            if chunk is None:
+                missing.append (index)
+            else:
+                chunks [index] = chunk
+
+        runs = []
+        for index in missing:
+            if runs and runs [-1][1] == index - 1:
+                runs [-1][1] = index
+            else:
+                runs.append ([index, index])
+
+        return chunks, [(run_first * span + phase, (run_last + 1) * span + phase - step) for run_first, run_last in runs]
+
+    def store (self, query_string, step, run_start, run_end, series_list, chunks):
+        # Split the series of a fetched run into its chunks, added to chunks and cached unless recent
+        span = step * self.chunk_points
+        phase = run_start % step
+        horizon = time.time () - self.recent_seconds
+
+        run_chunks = dict ((index, []) for index in range ((run_start - phase) // span, (run_end - phase) // span + 1))
+        for series in series_list:
+            split = {}
+            for value in series ["values"]:
+                split.setdefault (int ((value [0] - phase) // span), []).append (value)
+            for index, values in split.items ():
+                if index in run_chunks:
+                    run_chunks [index].append ((series ["metric"], values))
+
+        for index, chunk in run_chunks.items ():
+            chunks [index] = chunk
+            if (index + 1) * span + phase - step <= horizon:
+                self.put ((query_string, step, phase, index), chunk)
+
+    def stitch (self, chunks, start_time, end_time):
+        # Stitch the chunks back into one series per label set, trimmed to the requested range
+        stitched = merge_series ((metric, [v for v in values if start_time <= v [0] <= end_time])
+                                 for index in sorted (chunks) for metric, values in chunks [index])
+
+        return [series for series in stitched if series ["values"]]
+
+    def time_range_series (self, fetch, query_string, start_time, end_time, step):
+        """
+            Returns the series of the query between start_time and end_time, like fetch would.
+
+            fetch (query_string, start_time, end_time, step) runs the range query against the
+            target and returns its list of series, or None on failure.
+        """
+        if not self.cacheable (start_time, end_time, step):
+            return fetch (query_string, start_time, end_time, step)
+
+        # Fetch each contiguous run of missing chunks with a single query
+        chunks, runs = self.lookup (query_string, start_time, end_time, step)
+        for run_start, run_end in runs:
+            series_list = fetch (query_string, run_start, run_end, step)
+            if series_list is None:
+                return None
+            self.store (query_string, step, run_start, run_end, series_list, chunks)
+
+        return self.stitch (chunks, start_time, end_time)
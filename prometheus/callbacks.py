@@ -1,66 +1,495 @@
+import bisect
+import concurrent.futures
+import heapq
+import logging
+import math
+import threading
+import time
+
 from portal.objects import *
-from prometheus.api import time_range_values
+from portal.statistics import resolution, statistic_functions, summarize
+from prometheus.api import PrometheusClient, instant_vector, label_matcher, time_range_series
+from prometheus.backends import Backend, BackendGroup
+from prometheus.cache import RangeCache
+from prometheus.discovery import ObjectDiscovery
+from proxy.timing import phase
+
+logger = logging.getLogger (__name__)
+
+backend_lock = threading.Lock ()
+
+# The top N fallback evaluates at the step a subquery without one uses, Prometheus' default evaluation interval,
+# made coarser when the range would need more points per series than a range query returns
+TOPN_STEP = 60
+TOPN_MAX_POINTS = 11000
+
+def recent_seconds (systems):
+    # Recent data may still change, unless the data source says it does not
+    if systems.get ("always_request_recent_data", True):
+        return systems.get ("cache_recent_seconds", 300)
+    return 0
+
+def range_cache (systems):
+    if systems.get ("cache_max_points", 0) <= 0:
+        return None
+
+    return RangeCache (max_points = systems ["cache_max_points"],
+        chunk_points = systems.get ("cache_chunk_points", 240), recent_seconds = recent_seconds (systems))
+
+def prometheus_client (systems, target, metrics = None):
+    # The target_ options of the systems configuration, overridden by those set on the target itself
+    option = lambda name, default: target.get (name, systems.get ("target_" + name, default))
+
+    return PrometheusClient (target ["hostname"], target ["port"],
+        pool_maxsize = option ("pool_maxsize", 10),
+        pool_block = option ("pool_block", True),
+        retries = option ("retries", 3),
+        backoff_factor = option ("retry_backoff", 0.5),
+        timeout = option ("timeout", 60),
+        max_in_flight = option ("max_in_flight", None),
+        cache = range_cache (systems),
+        coalesce = systems.get ("coalesce_queries", True),
+        shard_points = systems.get ("query_shard_points", 0),
+        metrics = metrics)
+
+def startup (app):
+    systems = app.config ["systems"]
+
+    # One group of pooled clients per app, shared by every request thread
+    with backend_lock:
+        if "backend" not in app.config:
+            targets = systems.get ("targets") or [{"hostname": systems ["target_hostname"], "port": systems ["target_port"]}]
+
+            backends = []
+            for target in targets:
+                name = target.get ("name", str (target ["hostname"]) + ":" + str (target ["port"]))
+                backends.append (Backend (name, prometheus_client (systems, target, app.config.get ("proxy_metrics")), target.get ("objects")))
+            app.config ["backend"] = BackendGroup (backends)
+
+            if "proxy_metrics" in app.config:
+                app.config ["proxy_metrics"].add_collector (lambda: backend_metrics (app.config ["backend"]))
+
+        # Optionally build the inventory from the label values in Prometheus, on a background thread, and hand
+        # the objects found to the app through the publish hook it provides
+        publish = app.config.get ("publish_discovered_objects")
+        if systems.get ("object_discovery", False) and publish is None:
+            logger.warning ("object_discovery is set, but the app has no publish_discovered_objects hook")
+        elif systems.get ("object_discovery", False) and "object_discovery" not in app.config:
+            app.config ["object_discovery"] = ObjectDiscovery (app.config ["backend"],
+                lambda: discoverable_object_type_ids (app),
+                publish,
+                interval_seconds = systems.get ("discovery_interval_seconds", 300),
+                full_refresh_every = systems.get ("discovery_full_refresh_every", 12),
+                lookback_seconds = systems.get ("discovery_lookback_seconds", 86400))
+            app.config ["object_discovery"].start ()
+
+    return app.config ["backend"]
+
+def backend_metrics (group):
+    # The counters each backend client keeps, read when /metrics is scraped
+    samples = {}
+    for b in group.backends:
+        stats = b.client.stats ()
+        labels = {"backend": b.name}
+        samples.setdefault ("in_flight", []).append ((labels, stats ["in_flight"]))
+        for name, value in stats.get ("cache", {}).items ():
+            samples.setdefault ("cache_" + name, []).append ((labels, value))
+        if "single_flight" in stats:
+            samples.setdefault ("coalesced", []).append ((labels, stats ["single_flight"]["coalesced"]))
+
+    metrics = []
+    for name, metric_type, help in (("in_flight", "gauge", "Queries in flight to the backend."),
+                                    ("cache_hits", "counter", "Range cache chunks served from the cache."),
+                                    ("cache_misses", "counter", "Range cache chunks fetched from the backend."),
+                                    ("cache_evictions", "counter", "Range cache chunks evicted."),
+                                    ("cache_points", "gauge", "Samples held in the range cache."),
+                                    ("coalesced", "counter", "Queries that shared an identical query in flight.")):
+        if name in samples:
+            metrics.append (("portal_proxy_backend_" + name + ("_total" if metric_type == "counter" else ""), metric_type, help, samples [name]))
+
+    return metrics
+
+def discoverable_object_type_ids (app):
+    # Every object type, unless the object types model sets discover to False for it
+    return [ot ["id"] for ot in app.config ["models"]["objecttypes"] if ot.get ("discover", True)]
+
+def backend (app):
+    # Apps whose callbacks configuration has no startup entry create the backends on first use
+    if "backend" not in app.config:
+        return startup (app)
+
+    return app.config ["backend"]
+
+def backend_status (app):
+    status = backend (app).stats ()
+    if "object_discovery" in app.config:
+        status ["object_discovery"] = app.config ["object_discovery"].stats ()
+
+    return status
 
 def object_search (app, object_filters):
 
     search_response = SearchResponse (valid_interval = 120)
 
+    scanned = 0
+    inventory = app.config ["models"]["inventory"]
     for object_filter in object_filters:
-        portal_objects = app.config ["objects"]
-        for portal_object in portal_objects:
-            if (object_filter.object_type_id == portal_object ["object_type_id"]):
-                if (object_filter.instance_id == portal_object ["object_id"]) or (object_filter.instance_id == "*"):
-                    obj = ObjectDefinition (object_type_id = portal_object ["object_type_id"], object_id = portal_object ["object_id"],
-                        display_name = portal_object ["display_name"])  
-                    search_result = SearchResult (obj = obj, value = 100, parent_object_filters = [object_filter])
-                    search_response.add_search_result (search_result)
+        for obj in inventory.lookup (object_filter):
+            search_result = SearchResult (obj = obj, value = 100, parent_object_filters = [object_filter])
+            search_response.add_search_result (search_result)
+            scanned += 1
+
+    if "proxy_metrics" in app.config:
+        app.config ["proxy_metrics"].objects_scanned.inc (scanned, "object_search")
                 
     return search_response
 
+def type_ahead_search (app, search_string, object_type_ids, max_results):
+
+    search_response = SearchResponse (valid_interval = 120)
+
+    inventory = app.config ["models"]["inventory"]
+    objects = inventory.type_ahead (search_string, object_type_ids = object_type_ids, max_results = max_results)
+    for obj in objects:
+        search_response.add_search_result (SearchResult (obj = obj))
+
+    if "proxy_metrics" in app.config:
+        app.config ["proxy_metrics"].objects_scanned.inc (len (objects), "type_ahead_search")
+
+    return search_response
+
+def object_ids_by_type (objects):
+    # Group the distinct object ids by object type, keeping the order in which they were found
+    ids_by_type = {}
+    for obj in objects:
+        ids_by_type.setdefault (obj.object_type_id, {})[obj.object_id] = None
+
+    return ids_by_type
+
+def values_by_object (series_list, label):
+    # Split a matrix back out per object; like a single object query, the first series of an object is used
+    values = {}
+    for series in series_list:
+        object_id = series ["metric"].get (label)
+        if object_id is not None and object_id not in values:
+            values [object_id] = series ["values"]
+
+    return values
+
+def is_true (value):
+    # Query string flags arrive as strings, so "false" must not be treated as set
+    if isinstance (value, str):
+        return value.lower () in ("true", "1", "yes")
+    return bool (value)
+
+def topn_pushdown (client, metric_id, object_type_id, object_ids, n, start_time, end_time, ascending):
+    # Rank the objects of one type in Prometheus: the max of each object's summed series over the window, then topk/bottomk
+    range_seconds = max (int (end_time) - int (start_time), 1)
+    rank = "bottomk" if ascending else "topk"
+    metric_query = rank + " (" + str (n) + ", max_over_time (sum by (" + object_type_id + ") (" + metric_id + \
+        "{" + label_matcher (object_type_id, object_ids) + "}) [" + str (range_seconds) + "s:]))"
+
+    samples = instant_vector (client, query_string = metric_query, time = end_time)
+    if samples is None:
+        return None
+
+    values = {}
+    for sample in samples:
+        object_id = sample ["metric"].get (object_type_id)
+        value = float (sample ["value"][1])
+        if object_id is not None and not math.isnan (value):
+            values [object_id] = value
+
+    return values
+
+def topn_values (client, metric_id, object_type_id, object_ids, n, start_time, end_time, ascending):
+    # The ranking value of each object on one backend: at least its top n, or every object it has data for
+    values = topn_pushdown (client, metric_id, object_type_id, object_ids, n, start_time, end_time, ascending)
+    if values is not None:
+        return values
+
+    # Pushdown is not possible (e.g. no subquery support), so rank on the same values here: the max of each
+    # object's summed series over a range query at the step the subquery would have used
+    range_seconds = max (int (end_time) - int (start_time), 1)
+    step = max (TOPN_STEP, -(-range_seconds // TOPN_MAX_POINTS))
+    metric_query = "sum by (" + object_type_id + ") (" + metric_id + "{" + label_matcher (object_type_id, object_ids) + "})"
+
+    series_list = time_range_series (client, query_string = metric_query, start_time = start_time, end_time = end_time, step = step)
+
+    values = {}
+    for series in series_list or []:
+        object_id = series ["metric"].get (object_type_id)
+        samples = [float (value) for timestamp, value in series ["values"]]
+        samples = [sample for sample in samples if not math.isnan (sample)]
+        if object_id is not None and samples:
+            values [object_id] = max (samples)
+
+    return values
+
 def topn_search (app, object_filters, metric_id, n_value, start_time, end_time, ascending):
-    target_hostname = app.config ["systems"]["target_hostname"]
-    target_port = app.config ["systems"]["target_port"]
+    group = backend (app)
 
-    search_response = object_search (app, object_filters)
-    step = int(end_time) - int(start_time)
+    n = int (n_value)
+    ascending = is_true (ascending)
 
-    # pull objects out of search results
+    with phase ("search"):
+        search_response = object_search (app, object_filters)
 
-    # iterate over search results and update values
+    # Keep the first search result for each object, as the one that is ranked and returned
+    search_results = {}
     for search_result in search_response.search_results:
         obj = search_result.object
-        metric_query = "sum (" + metric_id + "{" + obj.object_type_id + "=\"" + obj.object_id + "\"})"
-       
-        search_result.value = time_range_values (hostname = target_hostname, port = target_port, query_string = metric_query, 
-            start_time = start_time, end_time = end_time, step = step, top = True)
+        search_results.setdefault ((obj.object_type_id, obj.object_id), search_result)
 
-    # sort and top
-    search_response.search_results.sort (reverse = not ascending)
-    search_response.search_results [:int (n_value)]
+    # Rank each object type on each backend that serves it, all in parallel
+    queries = []
+    ids_by_type = object_ids_by_type ([search_result.object for search_result in search_results.values ()])
+    for object_type_id, object_ids in ids_by_type.items ():
+        for b, ids in group.partition (object_type_id, object_ids):
+            future = group.submit (topn_values, b.client, metric_id, object_type_id, ids, n, start_time, end_time, ascending)
+            queries.append ((object_type_id, b, future))
 
-    return search_response
+    # An object served by several backends is ranked by its best value among them
+    better = min if ascending else max
+    candidates = {}
+    errors = []
+    for object_type_id, b, future in queries:
+        try:
+            with phase ("backend"):
+                values = future.result ()
+        except Exception as error:
+            logger.warning ("Top N query for %s on backend %s failed: %s", metric_id, b.name, error)
+            errors.append (error)
+            continue
 
+        for object_id, value in values.items ():
+            search_result = search_results.get ((object_type_id, object_id))
+            if search_result is None:
+                continue
+            if search_result in candidates:
+                value = better (candidates [search_result], value)
+            candidates [search_result] = value
 
-def time_series_data (app, object_filters, metric_ids, statistic_id, request_id, suggested_summary_rule, start_time, end_time, step):
-   
-    data_responses = []
- 
-    target_hostname = app.config ["systems"]["target_hostname"]
-    target_port = app.config ["systems"]["target_port"]
+    if errors and len (errors) == len (queries):
+        raise errors [0]
 
-    search_response = object_search (app, object_filters)
-     
-    for search_result in search_response.search_results:
-        obj = search_result.object
+    for search_result, value in candidates.items ():
+        search_result.value = value
+
+    # Select the overall top n with a bounded heap rather than sorting every candidate
+    if ascending:
+        top_results = heapq.nsmallest (n, candidates, key = lambda search_result: search_result.value)
+    else:
+        top_results = heapq.nlargest (n, candidates, key = lambda search_result: search_result.value)
+
+    return SearchResponse (search_results = top_results, valid_interval = search_response.valid_interval)
+
+def value_queries (group, ids_by_metric_type):
+    # One range query per metric, object type and backend, covering every requested object that backend serves:
+    # [(metric_id, object_type_id, backend, query_string)]
+    queries = []
+    for (metric_id, object_type_id), object_ids in ids_by_metric_type.items ():
+        for b, ids in group.partition (object_type_id, object_ids):
+            queries.append ((metric_id, object_type_id, b, metric_id + "{" + label_matcher (object_type_id, ids) + "}"))
+
+    return queries
+
+def merge_values (queries, results):
+    # results holds the list of series, None or the exception of each query; a backend that failed only
+    # leaves its own objects without data, unless every query failed
+    values = {}
+    errors = []
+    for (metric_id, object_type_id, b, query_string), series_list in zip (queries, results):
+        if isinstance (series_list, Exception):
+            logger.warning ("Query for %s on backend %s failed: %s", metric_id, b.name, series_list)
+            errors.append (series_list)
+            continue
+
+        if series_list is None:
+            continue
+        # Objects served by more than one backend keep the values of the first
+        for object_id, object_values in values_by_object (series_list, object_type_id).items ():
+            values.setdefault ((metric_id, object_type_id, object_id), object_values)
+
+    if errors and len (errors) == len (queries):
+        raise errors [0]
+
+    return values
+
+def remaining_seconds (deadline):
+    # The time left before the monotonic deadline of a call, or None without one
+    if deadline is None:
+        return None
+
+    remaining = deadline - time.monotonic ()
+    if remaining <= 0:
+        raise concurrent.futures.TimeoutError ()
+    return remaining
+
+def fetch_values (group, ids_by_metric_type, start_time, end_time, step, deadline = None):
+    # Run the queries of every metric, object type and backend concurrently, each with the time left before
+    # the deadline as its timeout; raises concurrent.futures.TimeoutError once the deadline has passed
+    queries = value_queries (group, ids_by_metric_type)
+    timeout = remaining_seconds (deadline)
+    futures = [group.submit (time_range_series, b.client, query_string = query_string,
+        start_time = start_time, end_time = end_time, step = step, timeout = timeout)
+        for metric_id, object_type_id, b, query_string in queries]
+
+    results = []
+    for future in futures:
+        try:
+            results.append (future.result (timeout = remaining_seconds (deadline)))
+        except concurrent.futures.TimeoutError:
+            raise
+        except Exception as error:
+            results.append (error)
+
+    # Queries that timed out at the deadline fail the whole call, rather than leave their objects without data
+    remaining_seconds (deadline)
+
+    return merge_values (queries, results)
+
+def settled_horizon (systems, start_time, end_time, step):
+    # The last evaluation timestamp of the request outside the recent window, or None if all of it is recent
+    horizon = min (int (time.time ()) - recent_seconds (systems), end_time)
+    if horizon < start_time:
+        return None
+
+    return start_time + (horizon - start_time) // step * step
+
+def last_valid_timestamp (data_points, horizon):
+    # The last data point of the series at or before the settled horizon: it and everything before it are
+    # final, while a series that stopped short of the horizon may still have later samples arriving
+    if horizon is None:
+        return None
+
+    index = bisect.bisect_right (data_points.timestamps, horizon)
+    if index == 0:
+        return None
+
+    return int (data_points.timestamps [index - 1])
+
+def plan_batch (app, data_requests, start_time, end_time, step):
+    """
+        Searches the objects of a batch of data requests, and works out the queries that answer it.
+        Returns (plans, functions, summarized, fetches), where fetches is a list of
+        (ids_by_metric_type, start_time, end_time, step) for fetch_values, and the rest is passed
+        on to batch_responses with the values fetched.
+    """
+    objects_by_filters = {}
+    plans = []
+    for request_id, object_filters, metric_ids, statistic_id in data_requests:
+        filters_key = tuple ((object_filter.object_type_id, object_filter.instance_id) for object_filter in object_filters)
+        if filters_key not in objects_by_filters:
+            with phase ("search"):
+                search_response = object_search (app, object_filters)
+            objects_by_filters [filters_key] = [search_result.object for search_result in search_response.search_results]
+        plans.append ((request_id, objects_by_filters [filters_key], metric_ids, statistic_id))
+
+    # Metrics with any statistic other than raw are fetched at a finer step, and every statistic of them,
+    # raw included, is computed from those same samples; the others are fetched at the requested step
+    systems = app.config ["systems"]
+    functions = statistic_functions (app.config ["models"]["statistics"])
+    summarized = set ()
+    for request_id, objects, metric_ids, statistic_id in plans:
+        if functions.get (statistic_id, "raw") != "raw":
+            summarized.update (metric_ids)
+
+    ids_by_metric_type = {}
+    summarized_ids_by_metric_type = {}
+    for request_id, objects, metric_ids, statistic_id in plans:
         for metric_id in metric_ids:
-            metric_query = metric_id + "{" + obj.object_type_id + "=\"" + obj.object_id + "\"}"
-                
-            values = time_range_values (hostname = target_hostname, port = target_port, query_string = metric_query, 
-                start_time = start_time, end_time = end_time, step = step, top = False)
-   
-            data_points = list (map (lambda m: DataPoint (timestamp = m[0], value = m[1]), values))
-            mv = MetricValue (metric_id = metric_id, statistic_id = statistic_id, data_points = data_points, summary_rule = suggested_summary_rule)
-            data_response = DataResponse (data_request_id = request_id, metric_values = [mv, ])
-            data_responses.append (data_response)
+            ids = summarized_ids_by_metric_type if metric_id in summarized else ids_by_metric_type
+            for obj in objects:
+                ids.setdefault ((metric_id, obj.object_type_id), {})[obj.object_id] = None
+
+    fetches = [(ids_by_metric_type, start_time, end_time, step)]
+    if summarized_ids_by_metric_type:
+        fine_step = resolution (start_time, end_time, step, systems.get ("statistics_native_step", 60),
+            systems.get ("statistics_max_points", 11000))
+        # Reach back one step before start_time, so that the first bucket is complete
+        fetches.append ((summarized_ids_by_metric_type, start_time - step + fine_step, end_time, fine_step))
+
+    return plans, functions, summarized, fetches
+
+def release (uses, cache, key):
+    # Drop cache [key] once the last data response that uses it has been built
+    uses [key] -= 1
+    if uses [key] == 0:
+        cache.pop (key, None)
+
+def batch_responses (app, plans, functions, summarized, values, suggested_summary_rule, start_time, end_time, step):
+    """
+        Yields the DataResponse of each object and metric of each data request, in order.
+
+        The data points of each (object, metric, statistic) are built once and shared by the data
+        requests that ask for them. They are released after their last use, and so are the values
+        in values they were built from. A streamed batch only holds the data it has not sent yet.
+    """
+    horizon = settled_horizon (app.config ["systems"], start_time, end_time, step)
+
+    # The data responses still to be built from each (object, metric) values and each data point array
+    uses = {}
+    for request_id, objects, metric_ids, statistic_id in plans:
+        function = functions.get (statistic_id, "raw")
+        for obj in objects:
+            for metric_id in metric_ids:
+                key = (metric_id, obj.object_type_id, obj.object_id)
+                uses [key] = uses.get (key, 0) + 1
+                uses [key + (function, )] = uses.get (key + (function, ), 0) + 1
+
+    data_points_by_key = {}
+    for request_id, objects, metric_ids, statistic_id in plans:
+        function = functions.get (statistic_id, "raw")
+        for obj in objects:
+            for metric_id in metric_ids:
+                with phase ("convert"):
+                    key = (metric_id, obj.object_type_id, obj.object_id)
+                    data_points = data_points_by_key.get (key + (function, ))
+                    if data_points is None:
+                        if metric_id in summarized:
+                            data_points = summarize (values.get (key, []), function, start_time, end_time, step)
+                        else:
+                            data_points = DataPointArray.from_pairs (values.get (key, []))
+                        data_points_by_key [key + (function, )] = data_points
+
+                    mv = MetricValue (metric_id = metric_id, statistic_id = statistic_id, data_points = data_points, summary_rule = suggested_summary_rule,
+                        last_valid_timestamp = last_valid_timestamp (data_points, horizon))
+                    data_response = DataResponse (data_request_id = request_id, metric_values = [mv, ])
 
-    return data_responses
+                    release (uses, data_points_by_key, key + (function, ))
+                    release (uses, values, key)
+
+                yield data_response
+
+def time_series_batch (app, data_requests, suggested_summary_rule, start_time, end_time, step, deadline = None):
+    """
+        Answers all the data requests of one time_series_data call together. data_requests is a list of
+        (request_id, object_filters, metric_ids, statistic_id).
+
+        Each distinct set of object filters is searched once, and every (object, metric) pair is
+        fetched once for the whole batch, however many data requests and statistics ask for it.
+        The queries are run before this returns. The data responses are then built one at a time
+        as the returned iterator is consumed, in the order of the data requests.
+
+        deadline is an optional time.monotonic () deadline. The queries are given the time left as
+        their timeout, and concurrent.futures.TimeoutError is raised once it has passed.
+
+        Each metric value carries the last_valid_timestamp of its series, so that Portal only
+        requests the data after it again.
+    """
+    group = backend (app)
+
+    plans, functions, summarized, fetches = plan_batch (app, data_requests, start_time, end_time, step)
+
+    values = {}
+    with phase ("backend"):
+        for ids_by_metric_type, fetch_start_time, fetch_end_time, fetch_step in fetches:
+            values.update (fetch_values (group, ids_by_metric_type, fetch_start_time, fetch_end_time, fetch_step, deadline))
+
+    return batch_responses (app, plans, functions, summarized, values, suggested_summary_rule, start_time, end_time, step)
+
+def time_series_data (app, object_filters, metric_ids, statistic_id, request_id, suggested_summary_rule, start_time, end_time, step):
+   
+    return list (time_series_batch (app, [(request_id, object_filters, metric_ids, statistic_id)], suggested_summary_rule,
+        start_time, end_time, step))
@@ -0,0 +1,116 @@
+"""
+    Discovery of Portal objects from the label values in Prometheus, refreshed in the background.
+"""
+
+import logging
+import threading
+import time
+
+from prometheus.api import label_values
+
+logger = logging.getLogger (__name__)
+
+class ObjectDiscovery (object):
+    """
+        Keeps a list of discovered objects, one per value of each object type label, and hands it to
+        publish whenever it changes. Object type ids from the object types model are used as the
+        Prometheus label names.
+
+        Most refreshes are incremental: only the label values of series seen since the previous
+        refresh are fetched and added. Every full_refresh_every refreshes, the values of the last
+        lookback_seconds are fetched instead and replace the list, so objects that went away are
+        dropped.
+
+        group
+            BackendGroup used for the label values queries; the values of every backend are merged.
+
+        object_type_ids
+            Function returning the object type ids to discover, read on every refresh so that a
+            reloaded object types model is picked up.
+
+        publish
+            Function called with the full list of discovered object dictionaries.
+    """
+
+    def __init__ (self, group, object_type_ids, publish, interval_seconds = 300, full_refresh_every = 12,
+                 lookback_seconds = 86400):
+        self.group = group
+        self.object_type_ids = object_type_ids
+        self.publish = publish
+        self.interval_seconds = interval_seconds
+        self.full_refresh_every = full_refresh_every
+        self.lookback_seconds = lookback_seconds
+
+        self.objects = {}
+        self.refreshes = 0
+        self.last_refresh = None
+        self.stopped = threading.Event ()
+        self.thread = None
+
+    def label_values (self, object_type_id, start_time, end_time):
+        # Union of the label values of the backends that answered, each limited to the objects it serves,
+        # or None if none did
+        try:
+            results = self.group.fan_out (label_values, object_type_id, start_time = start_time, end_time = end_time)
+        except Exception:
+            logger.exception ("Label values of %s could not be fetched", object_type_id)
+            return None
+
+        results = [(b, values) for b, values in results if values is not None]
+        if not results:
+            return None
+
+        return list (dict.fromkeys (value for b, values in results for value in values if b.serves (object_type_id, value)))
+
+    def refresh (self):
+        now = int (time.time ())
+        full = self.last_refresh is None or self.refreshes % self.full_refresh_every == 0
+
+        # Incremental refreshes overlap the previous one by an interval, so no series is missed between them
+        if full:
+            start_time = now - self.lookback_seconds
+        else:
+            start_time = self.last_refresh - self.interval_seconds
+
+        objects = {} if full else dict (self.objects)
+        for object_type_id in self.object_type_ids ():
+            values = self.label_values (object_type_id, start_time, now)
+            if values is None:
+                # Keep what is known about a type whose label values could not be fetched
+                values = []
+                for key in self.objects:
+                    if key [0] == object_type_id:
+                        objects [key] = self.objects [key]
+
+            for value in values:
+                objects [(object_type_id, value)] = {"object_type_id": object_type_id, "object_id": value, "display_name": value}
+
+        self.refreshes += 1
+        self.last_refresh = now
+
+        changed = objects.keys () != self.objects.keys ()
+        self.objects = objects
+        if changed:
+            self.publish (list (objects.values ()))
+
+        return changed
+
+    def run (self):
+        while True:
+            try:
+                self.refresh ()
+            except Exception:
+                logger.exception ("Object discovery refresh failed")
+
+            if self.stopped.wait (self.interval_seconds):
+                break
+
+    def start (self):
+        self.thread = threading.Thread (target = self.run, name = "object-discovery", daemon = True)
+        self.thread.start ()
+
+    def stop (self):
+        self.stopped.set ()
+
+    def stats (self):
+        return {"objects": len (self.objects), "refreshes": self.refreshes, "last_refresh": self.last_refresh}
@@ -17,4 +17,10 @@ if __name__ == "__main__" and __package__ is None:
                       config = "config.yaml",
                       callbacks = "callbacks.yaml")
 
-    app.run (app.config ["systems"]["proxy_hostname"], app.config ["systems"]["proxy_port"], debug = True, use_reloader = False, threaded = True) 
+    if app.config ["systems"].get ("serve_asgi", False):
+        import uvicorn
+        from proxy.asgi import create_asgi_app
+
+        uvicorn.run (create_asgi_app (app), host = app.config ["systems"]["proxy_hostname"], port = app.config ["systems"]["proxy_port"])
+    else:
+        app.run (app.config ["systems"]["proxy_hostname"], app.config ["systems"]["proxy_port"], debug = app.config ["systems"].get ("debug", False), use_reloader = False, threaded = True) 
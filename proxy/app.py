@@ -1,13 +1,27 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor
+import concurrent.futures
 from datetime import datetime
+import gzip
+import hashlib
+import itertools
+import threading
+import time
 import yaml
+import importlib
 import importlib.util
-from importlib import import_module
 
-from flask import Flask, jsonify, request
+from flask import Flask, abort, g, jsonify, request
 from flask.json import JSONEncoder
 # from flask_caching import Cache
 
+from portal.encoding import PortalEncoder
 from portal.objects import *
+from proxy.inventory import ObjectInventory
+from proxy.metrics import CONTENT_TYPE, ProxyMetrics
+from proxy.modelcache import load_model_file
+from proxy.reloader import ModelReloader
+from proxy.timing import current_timings, finish_request, phase, start_request, submit
 
 # Define custom JSON encoder for Portal Objects
 class PortalObjectJSONEncoder (JSONEncoder):
@@ -17,6 +31,159 @@ class PortalObjectJSONEncoder (JSONEncoder):
         else:
             return JSONEncoder.default (self, obj)
 
+def portal_encoder (app):
+    # Same settings as jsonify: app.json_encoder for anything else, keys sorted and ASCII output as configured
+    sort_keys = app.config ["JSON_SORT_KEYS"]
+    ensure_ascii = app.config ["JSON_AS_ASCII"]
+    fallback = app.json_encoder (sort_keys = sort_keys, ensure_ascii = ensure_ascii, separators = (",", ":"))
+
+    return PortalEncoder (sort_keys = sort_keys, ensure_ascii = ensure_ascii, fallback = fallback,
+        backend = app.config ["systems"].get ("json_backend", "builtin"))
+
+def request_route ():
+    # The route rule of the current request, so the metrics are not labelled per URL
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+def pretty_print (app):
+    # Only when asked for, not whenever debug is on, so debugging does not change the responses
+    return app.config ["JSONIFY_PRETTYPRINT_REGULAR"]
+
+def streaming (app):
+    # Streamed responses are compact, so pretty printing turns streaming off
+    return app.config ["systems"].get ("stream_responses", False) and not pretty_print (app)
+
+def portal_response (app, obj):
+    # Pretty printed responses are left to jsonify; compact ones go through the precompiled encoder
+    if pretty_print (app):
+        return jsonify (obj)
+
+    with phase ("encode"):
+        body = app.config ["portal_encoder"].encode (obj) + "\n"
+    app.config ["proxy_metrics"].bytes_serialized.inc (len (body), request_route ())
+    return app.response_class (body, mimetype = app.config ["JSONIFY_MIMETYPE"])
+
+def portal_stream_response (app, chunks):
+    # Send the JSON text as it is produced, rather than holding the whole body in memory
+    bytes_serialized = app.config ["proxy_metrics"].bytes_serialized
+    route = request_route ()
+    timings = current_timings.get ()
+
+    def generate ():
+        # The phases timed while the body is produced count towards the request, whichever context runs it
+        current_timings.set (timings)
+        size = 0
+        try:
+            for chunk in chunks:
+                size += len (chunk)
+                yield chunk
+            yield "\n"
+        finally:
+            bytes_serialized.inc (size + 1, route)
+
+    return app.response_class (generate (), mimetype = app.config ["JSONIFY_MIMETYPE"])
+
+def catalog_models (config, systems):
+    # The Portal models behind the static catalog endpoints, built from the loaded configuration
+    catalog = {}
+
+    sv = config ["softwareversion"]
+    catalog ["software_version"] = SoftwareVersion (data_source_type = sv ["data_source_type"],
+                          major_version = sv ["major_version"],
+                          minor_version = sv ["minor_version"],
+                          display_string = sv ["display_string"],
+                          revision_number = sv ["revision_number"],
+                          build_number = sv ["build_number"])
+
+    catalog ["preferences"] = Preferences (update_object_cache_on_initial_sync = True,
+                               data_request_max_thread_count = 4,
+                               data_request_batch_limit = 500,
+                               heartbeat_request_interval_seconds = 60,
+                               always_request_recent_data = systems.get ("always_request_recent_data", True),
+                               supports_type_ahead_searches = systems.get ("type_ahead_search", False)
+                               )
+
+    gs = []
+    for gr in config ["granularities"]:
+        ### removed description and is_global while troubleshooting
+        gs.append (Granularity (granularity_id = gr ["granularity_id"], value_seconds = gr ["value_seconds"],
+                    time_window_seconds = gr ["time_window_seconds"], display_name = gr ["display_name"],
+                    storage_duration = gr ["storage_duration"]))
+    catalog ["granularities"] = gs
+
+    ots = []
+    for ot in config ["objecttypes"]:
+       ### add more options from file?
+       ots.append (ObjectType (id = ot ["id"], display_name = ot ["display_name"], 
+           plural_display_name = ot ["plural_display_name"], root_type = ot ["root_type"], enumerable = ot ["enumerable"],
+           applicable_metrics = ot ["applicable_metrics"],
+           has_data_source_provided_type_ahead = ot.get ("has_data_source_provided_type_ahead", systems.get ("type_ahead_search", False))))
+    catalog ["object_types"] = ots
+
+    catalog ["launch_urls"] = []
+    catalog ["default_thresholds"] = []
+
+    ms = []
+    for m in config ["metrics"]:
+        ms.append (Metric (metric_id = m ["metric_id"], unique_display_name = m ["unique_display_name"],
+            unit = m ["unit"]))
+    catalog ["metrics"] = ms
+
+    ### update with pull from file for all parameters 
+    stats = []
+    for s in config ["statistics"]:
+        stats.append (Statistic (id = s ["id"],
+                    display_name = s ["display_name"],
+                    is_default = s ["is_default"],
+                    is_primary = s ["is_primary"],
+                    suggested_aggregation_rule = None,
+                    data_points_time_aligned = False))
+    catalog ["statistics"] = stats
+
+    catalog ["object_property_definitions"] = []
+
+    return catalog
+
+def catalog_encoder (app):
+    # The catalog is rendered compact, or indented like jsonify when pretty printing is on
+    if pretty_print (app):
+        return app.json_encoder (sort_keys = app.config ["JSON_SORT_KEYS"], ensure_ascii = app.config ["JSON_AS_ASCII"],
+            indent = 2, separators = (", ", ": "))
+
+    return app.config ["portal_encoder"]
+
+class CatalogPayload (object):
+    """
+        A catalog response rendered once: the JSON body and its gzip variant, each with a strong ETag
+    """
+
+    def __init__ (self, obj, encoder):
+        self.body = (encoder.encode (obj) + "\n").encode ("utf-8")
+        self.etag = hashlib.sha1 (self.body).hexdigest ()
+        # mtime is fixed so the gzip variant, and its ETag, are the same across workers and restarts
+        self.gzip_body = gzip.compress (self.body, mtime = 0)
+        self.gzip_etag = self.etag + "-gzip"
+
+def render_catalog (config, systems, encoder):
+    return dict ((name, CatalogPayload (obj, encoder)) for name, obj in catalog_models (config, systems).items ())
+
+def catalog_response (app, name):
+    payload = app.config ["models"]["catalog"][name]
+
+    use_gzip = request.accept_encodings.quality ("gzip") > 0
+    etag = payload.gzip_etag if use_gzip else payload.etag
+
+    if request.if_none_match.contains_weak (etag):
+        response = app.response_class (status = 304)
+    else:
+        response = app.response_class (payload.gzip_body if use_gzip else payload.body, mimetype = app.config ["JSONIFY_MIMETYPE"])
+        if use_gzip:
+            response.headers ["Content-Encoding"] = "gzip"
+
+    response.set_etag (etag)
+    response.headers ["Vary"] = "Accept-Encoding"
+
+    return response
+
 def object_filters_from_json (object_filters):
     
     ofs = []
@@ -32,6 +199,23 @@ def object_filters_from_request (request):
     
     return object_filters_from_json (object_filters_json)
 
+def data_requests_from_json (data_requests_json):
+    # (request_id, object_filters, metric_ids, statistic_id) for each statistic of each data request
+    data_requests = []
+    for data_request in data_requests_json:
+        request_id = data_request ["data_request_id"]
+        object_filters = object_filters_from_json (data_request ["object_filters"])
+
+        # One entry per statistic asked for, with the metrics to compute it for
+        metric_ids_by_statistic = {}
+        for m in data_request ["metric_statistic_ids"]:
+            metric_ids_by_statistic.setdefault (m.get ("statistic_id") or "raw", []).append (m ["metric_id"])
+
+        for statistic_id, metric_ids in metric_ids_by_statistic.items ():
+            data_requests.append ((request_id, object_filters, metric_ids, statistic_id))
+
+    return data_requests
+
 def granularity_from_request (request):
     granularity_json = request.args.get ("granularity_id")
 
@@ -59,6 +243,49 @@ def start_end_times_from_request (request):
 
     return (start_time_seconds, end_time_seconds)
 
+class FanOut (object):
+    """
+        The calls of one request on an executor shared by the whole app, at most workers of them
+        running at a time, so that one large batch cannot hold every thread of the pool and keep
+        the other requests waiting. calls is a list of (function, args).
+    """
+
+    def __init__ (self, executor, calls, workers):
+        self.executor = executor
+        self.calls = deque (calls)
+        self.workers = max (workers, 1)
+        self.futures = deque ()
+
+    def fill (self):
+        running = sum (1 for future in self.futures if not future.done ())
+        while self.calls and running < self.workers:
+            function, args = self.calls.popleft ()
+            self.futures.append (submit (self.executor, function, *args))
+            running += 1
+
+    def results (self, deadline = None):
+        """
+            Yields the result of each call in order, submitting the next calls as others finish.
+            Raises concurrent.futures.TimeoutError once the monotonic deadline has passed.
+        """
+        while self.calls or self.futures:
+            self.fill ()
+            while not self.futures [0].done ():
+                timeout = None if deadline is None else max (deadline - time.monotonic (), 0)
+                done, running = concurrent.futures.wait ([future for future in self.futures if not future.done ()],
+                    timeout = timeout, return_when = FIRST_COMPLETED)
+                if not done:
+                    raise concurrent.futures.TimeoutError ()
+                self.fill ()
+
+            yield self.futures.popleft ().result ()
+
+    def cancel (self):
+        # Calls not yet submitted are dropped; those already running finish on their own
+        self.calls.clear ()
+        for future in self.futures:
+            future.cancel ()
+
 def load_config (conf_file = ""):
     config = {}
 
@@ -69,54 +296,130 @@ def load_config (conf_file = ""):
  
     return config
     
-def load_models (softwareversion = "", metrics = "", objects = "", objecttypes = "", granularities = "", statistics = ""):
+def load_model (model_file, use_cache = True, timings = None):
+    model, source, seconds = load_model_file (model_file, use_cache = use_cache)
+
+    if timings is not None:
+        timings.append ((model_file, source, seconds))
+
+    return model
+
+def load_models (softwareversion = "", metrics = "", objects = "", objecttypes = "", granularities = "", statistics = "",
+                 use_cache = True, timings = None):
    
     config = {}
 
-    sv = None
-    with open (softwareversion) as f:
-        sv = yaml.full_load (f)
-    config ["softwareversion"] = sv 
-    
-    m = None
-    with open (metrics) as f:
-        m = yaml.full_load (f)
-    config ["metrics"] = m
-
-    o = None
-    with open (objects) as f:
-        o = yaml.full_load (f)
-    config ["objects"] = o
-
-    ot = None
-    with open (objecttypes) as f:
-        ot = yaml.full_load (f)
-    config ["objecttypes"] = ot
-
-    g = None
-    with open (granularities) as f:
-        g = yaml.full_load (f)
-    config ["granularities"] = g
-
-    s = None
-    with open (statistics) as f:
-        s = yaml.full_load (f)
-    config ["statistics"] = s
+    config ["softwareversion"] = load_model (softwareversion, use_cache, timings)
+    config ["metrics"] = load_model (metrics, use_cache, timings)
+    config ["objects"] = load_model (objects, use_cache, timings)
+    config ["objecttypes"] = load_model (objecttypes, use_cache, timings)
+    config ["granularities"] = load_model (granularities, use_cache, timings)
+    config ["statistics"] = load_model (statistics, use_cache, timings)
 
     return config 
 
-def get_function (callback):
-    imported_function = None
+def build_models (app, config):
+    # A complete set of models: the parsed model files, plus the indexes and responses derived from them.
+    # A set is never changed once built; a reload builds a new one and swaps it in with a single assignment,
+    # so a request that reads app.config ["models"] once works on a consistent snapshot
+    models = dict (config)
+    # Objects from the objects model come first, so their display names win over discovered ones
+    models ["inventory"] = ObjectInventory ((models ["objects"] or []) + app.config.get ("discovered_objects", []))
+    models ["catalog"] = render_catalog (models, app.config ["systems"], catalog_encoder (app))
+
+    return models
+
+def update_discovered_objects (app, objects):
+    # Objects found by the backend are kept with the app and merged into every set of models built from now on
+    with app.config ["models_lock"]:
+        app.config ["discovered_objects"] = objects
+        app.config ["models"] = build_models (app, app.config ["models"])
+
+def reload_models (app, changed):
+    # Re-parse the changed model files only, then rebuild and swap in the models; requests never wait on this
+    with app.config ["models_lock"]:
+        config = dict (app.config ["models"])
+        for name in changed:
+            config [name] = load_model (app.config ["model_files"][name], app.config ["systems"].get ("model_cache", True))
+
+        app.config ["models"] = build_models (app, config)
+
+def get_module (module_name, reload = False):
+    module = None
 
-    module_name, function_name = callback.rsplit (".", 1)
     spec = importlib.util.find_spec (module_name)
     if (spec is not None):
-        module = spec.loader.load_module ()
-        imported_function = getattr (module, function_name) 
+        # import_module is served from sys.modules after the first import; only re-execute on an explicit reload
+        module = importlib.import_module (module_name)
+        if reload:
+            module = importlib.reload (module)
+
+    return module
+
+def get_function (callback, reload = False, modules = None):
+    # modules, if given, keeps the modules already imported (or reloaded) by name, so each is only done once
+    imported_function = None
+
+    module_name, function_name = callback.rsplit (".", 1)
+    if modules is None:
+        module = get_module (module_name, reload = reload)
+    else:
+        if module_name not in modules:
+            modules [module_name] = get_module (module_name, reload = reload)
+        module = modules [module_name]
+
+    if module is not None:
+        imported_function = getattr (module, function_name, None)
     
     return imported_function
 
-def load_callbacks (callbacks):
+class CallbackRegistry (object):
+    """
+        Callback functions resolved once at startup, so requests do not re-import the callback modules.
+        A non-zero reload_seconds re-resolves the callbacks at most once per interval (development only).
+    """
+
+    def __init__ (self, callbacks, reload_seconds = 0, wrap = None):
+        self.callbacks = callbacks
+        self.reload_seconds = reload_seconds
+        self.wrap = wrap
+        self.functions = {}
+        self.last_loaded = 0
+        self.lock = threading.Lock ()
+
+    def load (self, reload = False):
+        functions = {}
+        # Each module is reloaded once per load, however many callbacks it provides
+        modules = {}
+        for callback_name, module_function_name in self.callbacks.items ():
+            if module_function_name is None or module_function_name == "":
+                continue
+
+            imported_function = get_function (module_function_name, reload = reload, modules = modules)
+            if imported_function is None:
+                return False
+            if self.wrap is not None:
+                imported_function = self.wrap (callback_name, imported_function)
+            functions [callback_name] = imported_function
+
+        # Swap in one assignment so readers never see a partially loaded set
+        self.functions = functions
+        self.last_loaded = time.monotonic ()
+        return True
+
+    def get (self, callback_name):
+        if self.reload_seconds > 0 and time.monotonic () - self.last_loaded >= self.reload_seconds:
+            # Only one request pays for the reload; the others keep using the current functions
+            if self.lock.acquire (blocking = False):
+                try:
+                    if time.monotonic () - self.last_loaded >= self.reload_seconds:
+                        self.load (reload = True)
+                finally:
+                    self.lock.release ()
+
+        return self.functions.get (callback_name)
+
+def load_callbacks (callbacks, reload_seconds = 0, wrap = None):
     config = {}
 
     cs = None
@@ -124,22 +427,18 @@ def load_callbacks (callbacks):
         cs = yaml.full_load (f)
     config ["callbacks"] = cs
 
-    # If loaded, check that module and function are imported, and if not, import right away
+    # Check that each module and function can be imported, and keep the resolved functions for the requests
     callback_names = ["object_search", "topn_search", "time_series_data"]
 
     for callback_name in callback_names:
-
-        module_function_name = config ["callbacks"][callback_name]
-        if module_function_name == "":
-            continue
-        
-        imported_function = get_function (module_function_name)
-
-        if imported_function is not None:
-            continue
-        else:
+        if callback_name not in config ["callbacks"]:
             return None
 
+    registry = CallbackRegistry (config ["callbacks"], reload_seconds = reload_seconds, wrap = wrap)
+    if not registry.load ():
+        return None
+    config ["callback_registry"] = registry
+
     return config
 
 def create_app (softwareversion, metrics, objects, objecttypes, granularities, statistics, config, callbacks):
@@ -152,145 +451,265 @@ def create_app (softwareversion, metrics, objects, objecttypes, granularities, s
     # Initialize configurations and definitions
     app.config.update (load_config (conf_file = config))
 
-    app.config.update (load_callbacks (callbacks = callbacks))
-
-    app.config.update (load_models (softwareversion = softwareversion, metrics = metrics, objects = objects, 
-        objecttypes = objecttypes, granularities = granularities, statistics = statistics))
+    # Metrics of the proxy itself, served on /metrics; every callback is timed
+    app.config ["proxy_metrics"] = ProxyMetrics ()
+
+    app.config.update (load_callbacks (callbacks = callbacks,
+        reload_seconds = app.config ["systems"].get ("callback_reload_seconds", 0),
+        wrap = app.config ["proxy_metrics"].timed_callback))
+
+    app.config ["model_files"] = {"softwareversion": softwareversion, "metrics": metrics, "objects": objects,
+        "objecttypes": objecttypes, "granularities": granularities, "statistics": statistics}
+
+    app.config ["portal_encoder"] = portal_encoder (app)
+
+    # The inventory index and the static catalog responses are built with the models, not on every request
+    app.config ["models_lock"] = threading.Lock ()
+    timings = []
+    started = time.perf_counter ()
+    config = load_models (use_cache = app.config ["systems"].get ("model_cache", True), timings = timings,
+        **app.config ["model_files"])
+    loaded = time.perf_counter ()
+    app.config ["models"] = build_models (app, config)
+    built = time.perf_counter ()
+
+    # Startup timing report: where the model files came from and how long parsing and indexing took
+    app.config ["startup_timings"] = {"files": timings, "load_seconds": loaded - started, "build_seconds": built - loaded}
+    for model_file, source, seconds in timings:
+        app.logger.info ("Loaded %s from %s in %.3fs", model_file, source, seconds)
+    app.logger.info ("Models loaded in %.3fs, indexes and catalog built in %.3fs", loaded - started, built - loaded)
+
+    # Optionally watch the model files and swap in new models when they change
+    model_reload_seconds = app.config ["systems"].get ("model_reload_seconds", 0)
+    if model_reload_seconds > 0:
+        app.config ["model_reloader"] = ModelReloader (app.config ["model_files"],
+            lambda changed: reload_models (app, changed), interval_seconds = model_reload_seconds)
+        app.config ["model_reloader"].start ()
+
+    # Data requests of every /time_series_data call in progress share one pool, each call using at most
+    # data_request_workers of its threads at a time
+    app.config ["data_request_executor"] = ThreadPoolExecutor (
+        max_workers = app.config ["systems"].get ("data_request_threads", 64))
+
+    # Data source callbacks publish the objects they discover through this hook, rather than importing the app
+    app.config ["publish_discovered_objects"] = lambda objects: update_discovered_objects (app, objects)
+
+    # Optional backend startup, e.g. to open the connections to the targets once for the whole app
+    startup_callback = app.config ["callback_registry"].get ("startup")
+    if startup_callback is not None:
+        startup_callback (app)
+
+    @app.before_request
+    def start_timer ():
+        g.request_timings = start_request (app.config ["systems"])
+
+    @app.after_request
+    def observe_request (response):
+        metrics = app.config ["proxy_metrics"]
+        route = request_route ()
+        method = request.method
+        timings = g.get ("request_timings")
+        if timings is None:
+            return response
+
+        def finish ():
+            metrics.request_seconds.observe (timings.total (), route, method, str (response.status_code))
+            if response.status_code >= 500:
+                metrics.errors.inc (1, "request", route)
+            return finish_request (app, timings, response, route)
+
+        if response.is_streamed:
+            # The body is produced after this returns, so the request is timed until it has been sent
+            header = timings.server_timing ()
+            if header:
+                response.headers ["Server-Timing"] = header
+            response.call_on_close (finish)
+            return response
+
+        return finish ()
+
+    @app.route('/metrics')
+    def proxy_metrics ():
+        return app.response_class (app.config ["proxy_metrics"].exposition (), content_type = CONTENT_TYPE)
 
-    # Initialize cache?
-
-    # Connect to targets?
     @app.route('/portal-api/v1/software_version')
     def software_version ():
-        sv = app.config ["softwareversion"]
-        version = SoftwareVersion (data_source_type = sv ["data_source_type"],
-                          major_version = sv ["major_version"],
-                          minor_version = sv ["minor_version"],
-                          display_string = sv ["display_string"],
-                          revision_number = sv ["revision_number"],
-                          build_number = sv ["build_number"])
-
-        return jsonify (version)
+        return catalog_response (app, "software_version")
 
     @app.route('/portal-api/v1/preferences')
     def preferences ():
-        return jsonify (Preferences (update_object_cache_on_initial_sync = True,
-                               data_request_max_thread_count = 4,
-                               data_request_batch_limit = 500,
-                               heartbeat_request_interval_seconds = 60,
-                               always_request_recent_data = True
-                               ))
+        return catalog_response (app, "preferences")
 
     @app.route('/portal-api/v1/granularities')
     def granularities():
-        gs = []
-
-        for g in app.config ["granularities"]:
-            ### removed description and is_global while troubleshooting
-            gs.append (Granularity (granularity_id = g ["granularity_id"], value_seconds = g ["value_seconds"],
-                        time_window_seconds = g ["time_window_seconds"], display_name = g ["display_name"],
-                        storage_duration = g ["storage_duration"]))
-
-        return jsonify (gs)
+        return catalog_response (app, "granularities")
 
 
     @app.route('/portal-api/v1/object_types')
     def object_types():
-        ots = []
-
-        for ot in app.config ["objecttypes"]:
-           ### add more options from file?
-           ots.append (ObjectType (id = ot ["id"], display_name = ot ["display_name"], 
-               plural_display_name = ot ["plural_display_name"], root_type = ot ["root_type"], enumerable = ot ["enumerable"],
-               applicable_metrics = ot ["applicable_metrics"]))
-
-        return jsonify (ots)
+        return catalog_response (app, "object_types")
 
 
     @app.route('/portal-api/v1/launch_urls')
     def launch_urls():
-        urls = []
-        return jsonify(urls)
+        return catalog_response (app, "launch_urls")
 
 
     @app.route('/portal-api/v1/default_thresholds')
     def default_thresholds():
-        thresholds=[]
-        return jsonify(thresholds)
+        return catalog_response (app, "default_thresholds")
 
 
     @app.route('/portal-api/v1/metrics')
     def metrics():
-
-        ms = []
-        for m in app.config ["metrics"]:
-            ms.append (Metric (metric_id = m ["metric_id"], unique_display_name = m ["unique_display_name"],
-                unit = m ["unit"]))
-
-        return jsonify (ms)
+        return catalog_response (app, "metrics")
 
     @app.route('/portal-api/v1/statistics')
     def statistics():
-  
-        ### update with pull from file for all parameters 
-        stats = []
-        for s in app.config ["statistics"]:
-            stats.append (Statistic (id = s ["id"],
-                        display_name = s ["display_name"],
-                        is_default = s ["is_default"],
-                        is_primary = s ["is_primary"],
-                        suggested_aggregation_rule = None,
-                        data_points_time_aligned = False))
-                               
-        return jsonify (stats)
+        return catalog_response (app, "statistics")
 
 
     @app.route('/portal-api/v1/object_property_definitions')
     def object_property_definitions():
-    
-        prop_defs = []
-        return jsonify(prop_defs)
+        return catalog_response (app, "object_property_definitions")
+
+
+    @app.route('/proxy-api/v1/backend_status')
+    def backend_status():
+        backend_status_callback = app.config ["callback_registry"].get ("backend_status")
+
+        status = {}
+        if backend_status_callback is not None:
+            status = backend_status_callback (app)
 
+        return portal_response (app, status)
 
     @app.route('/portal-api/v1/object_search', methods = ["post"])
     def object_search():
-        object_search_callback = get_function (app.config ["callbacks"]["object_search"])
+        object_search_callback = app.config ["callback_registry"].get ("object_search")
 
         object_filters = object_filters_from_request (request)
 
         ### for now, do not use time in object search
         ### start_time, end_time = start_end_times_from_request (request)
         
-        result = object_search_callback (app, object_filters) 
+        with phase ("search"):
+            result = object_search_callback (app, object_filters) 
 
-        return jsonify (result)
+        if streaming (app):
+            return portal_stream_response (app, app.config ["portal_encoder"].iterencode (result))
+
+        return portal_response (app, result)
+
+    @app.route('/portal-api/v1/type_ahead_search', methods = ["get", "post"])
+    def type_ahead_search():
+        type_ahead_search_callback = app.config ["callback_registry"].get ("type_ahead_search")
+        if type_ahead_search_callback is None:
+            abort (404)
+
+        search_string = request.args.get ("search_string", "")
+        object_type_ids = request.args.getlist ("object_type_id") or None
+        # Bounded on both sides, as a negative count would slice off the end of the matches instead
+        max_results = max (0, min (request.args.get ("max_results", 20, type = int), 
+            app.config ["systems"].get ("type_ahead_max_results", 100)))
+
+        with phase ("search"):
+            result = type_ahead_search_callback (app, search_string, object_type_ids, max_results)
+
+        return portal_response (app, result)
 
     @app.route("/portal-api/v1/time_series_data", methods = ["post"])
     def time_series_data():
-        time_series_data_callback = get_function (app.config ["callbacks"]["time_series_data"])
+        time_series_data_callback = app.config ["callback_registry"].get ("time_series_data")
+        time_series_batch_callback = app.config ["callback_registry"].get ("time_series_batch")
 
-        data_responses = []
         suggested_summary_rule = None
         start_time, end_time = start_end_times_from_request (request)
         granularity = granularity_from_request (request)
 
-        for data_request in request.json:
-            request_id = data_request ["data_request_id"]
-            object_filters = object_filters_from_json (data_request ["object_filters"])
-
-            metric_ids = list (map (lambda m: m ["metric_id"], data_request ["metric_statistic_ids"]))
-            ### for now, make an assumption here
-            statistic_id = "raw"
-
-            data_responses_from_request = time_series_data_callback (app, object_filters, metric_ids, statistic_id, request_id, 
-                suggested_summary_rule, start_time, end_time, granularity)
-            data_responses.extend (data_responses_from_request)
-
-        return jsonify (data_responses)
+        executor = app.config ["data_request_executor"]
+        workers = app.config ["systems"].get ("data_request_workers", 4)
+        deadline_seconds = app.config ["systems"].get ("data_request_deadline_seconds", 0)
+        deadline = time.monotonic () + deadline_seconds if deadline_seconds > 0 else None
+
+        data_requests = data_requests_from_json (request.json)
+
+        # A batch callback plans the whole body at once, sharing searches and queries between data requests, on
+        # the request thread; the deadline is enforced through the timeouts of its queries, and its data responses
+        # are built one at a time as they are sent. Otherwise each data request is answered on its own, concurrently
+        fan_out = None
+
+        def cancel ():
+            if fan_out is not None:
+                fan_out.cancel ()
+
+        # The queries run, and the first result is waited for, before the response starts: a missed deadline is
+        # a 504, and a failure of every query an error status, rather than a list that has already been begun.
+        # Only building and encoding the data responses is left to the body
+        try:
+            if time_series_batch_callback is not None:
+                results = ([data_response] for data_response in time_series_batch_callback (app, data_requests,
+                    suggested_summary_rule, start_time, end_time, granularity, deadline = deadline))
+            else:
+                fan_out = FanOut (executor, [(time_series_data_callback, (app, object_filters, metric_ids, statistic_id,
+                    request_id, suggested_summary_rule, start_time, end_time, granularity))
+                    for request_id, object_filters, metric_ids, statistic_id in data_requests], workers)
+                results = fan_out.results (deadline)
+
+            first = next (results, None)
+        except concurrent.futures.TimeoutError:
+            cancel ()
+            abort (504)
+        except Exception:
+            cancel ()
+            raise
+
+        if first is not None:
+            results = itertools.chain ([first], results)
+
+        # Collect in request order, so the responses keep the order of the data requests; each data request's
+        # results are released as soon as they have been consumed
+        points_returned = app.config ["proxy_metrics"].points_returned
+        def collect ():
+            for data_responses in results:
+                points_returned.inc (sum (len (mv.data_points) for data_response in data_responses
+                    for mv in data_response.metric_values))
+                for data_response in data_responses:
+                    yield data_response
+
+        if not streaming (app):
+            try:
+                data_responses = list (collect ())
+            except concurrent.futures.TimeoutError:
+                cancel ()
+                abort (504)
+
+            return portal_response (app, data_responses)
+
+        def stream ():
+            encoder = app.config ["portal_encoder"]
+
+            yield "["
+            first = True
+            try:
+                for data_response in collect ():
+                    yield ("" if first else ",") + encoder.encode (data_response)
+                    first = False
+            except concurrent.futures.TimeoutError:
+                # The response has already started, so a deadline missed after the first data response can only
+                # cut it short. The list is left unclosed, so Portal sees a broken response, not a complete one
+                app.logger.warning ("time_series_data deadline of %s seconds exceeded, response truncated", deadline_seconds)
+                return
+            finally:
+                # Also when the client goes away before the end of the response
+                cancel ()
+            yield "]"
+
+        return portal_stream_response (app, stream ())
 
     @app.route("/portal-api/v1/topn_search", methods=["post"])
     def topn_search():
-        topn_search_callback = get_function (app.config ["callbacks"]["topn_search"])
+        topn_search_callback = app.config ["callback_registry"].get ("topn_search")
 
         object_filters = object_filters_from_request (request)
         start_time, end_time = start_end_times_from_request (request)
@@ -300,6 +719,6 @@ def create_app (softwareversion, metrics, objects, objecttypes, granularities, s
 
         result = topn_search_callback (app, object_filters, metric_id, n_value, start_time, end_time, ascending)
 
-        return  jsonify (result)
+        return  portal_response (app, result)
    
     return app 
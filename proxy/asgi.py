@@ -0,0 +1,113 @@
+"""
+    Optional ASGI entry point for the proxy.
+
+    With a time_series_batch_async callback, /portal-api/v1/time_series_data is answered on the
+    event loop, so all the backend queries of a batch, and of every other batch in progress, are
+    multiplexed on one thread instead of each holding a thread of its own. Every other route,
+    and time_series_data without that callback, is served by the Flask app as is, through
+    asgiref's WSGI adapter. The request parsing, models and response encoding are those of the
+    Flask app.
+
+    Requires asgiref, and an ASGI server such as uvicorn to run it.
+"""
+
+import asyncio
+import json
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MultiDict
+
+from proxy.app import data_requests_from_json, granularity_from_request, portal_response, start_end_times_from_request
+from proxy.timing import finish_request, start_request
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+TIME_SERIES_DATA_PATH = "/portal-api/v1/time_series_data"
+
+class AsgiRequest (object):
+    """
+        The parts of a Flask request that the request parsing helpers of the app use.
+    """
+
+    def __init__ (self, scope, body):
+        self.args = MultiDict (parse_qsl (scope.get ("query_string", b"").decode ("latin-1"), keep_blank_values = True))
+        self.json = json.loads (body) if body else None
+
+async def read_body (receive):
+    chunks = []
+    while True:
+        message = await receive ()
+        chunks.append (message.get ("body", b""))
+        if not message.get ("more_body", False):
+            return b"".join (chunks)
+
+async def send_response (send, response):
+    # A Flask response, as the synchronous routes build it
+    headers = [(name.lower ().encode ("latin-1"), value.encode ("latin-1")) for name, value in response.headers.items ()]
+    await send ({"type": "http.response.start", "status": response.status_code, "headers": headers})
+    await send ({"type": "http.response.body", "body": response.get_data ()})
+
+async def lifespan (app, receive, send):
+    while True:
+        message = await receive ()
+        if message ["type"] == "lifespan.startup":
+            await send ({"type": "lifespan.startup.complete"})
+        elif message ["type"] == "lifespan.shutdown":
+            shutdown_callback = app.config ["callback_registry"].get ("shutdown_async")
+            if shutdown_callback is not None:
+                await shutdown_callback (app)
+            await send ({"type": "lifespan.shutdown.complete"})
+            return
+
+def create_asgi_app (app):
+    """
+        Wraps the Flask app returned by create_app in an ASGI application.
+    """
+    if WsgiToAsgi is None:
+        raise RuntimeError ("The ASGI mode needs asgiref")
+
+    wsgi = WsgiToAsgi (app)
+
+    async def time_series_data (callback, scope, receive, send):
+        timings = start_request (app.config ["systems"])
+        request = AsgiRequest (scope, await read_body (receive))
+
+        suggested_summary_rule = None
+        start_time, end_time = start_end_times_from_request (request)
+        granularity = granularity_from_request (request)
+        data_requests = data_requests_from_json (request.json)
+
+        metrics = app.config ["proxy_metrics"]
+        deadline_seconds = app.config ["systems"].get ("data_request_deadline_seconds", 0)
+        try:
+            data_responses = await asyncio.wait_for (callback (app, data_requests, suggested_summary_rule,
+                start_time, end_time, granularity), timeout = deadline_seconds if deadline_seconds > 0 else None)
+        except asyncio.TimeoutError:
+            response = app.response_class (status = 504)
+        else:
+            metrics.points_returned.inc (sum (len (mv.data_points) for data_response in data_responses
+                for mv in data_response.metric_values))
+            # A request context for the route, as the response helpers and the metrics labels expect
+            with app.test_request_context (TIME_SERIES_DATA_PATH, method = "POST"):
+                response = portal_response (app, data_responses)
+
+        metrics.request_seconds.observe (timings.total (), TIME_SERIES_DATA_PATH, "POST", str (response.status_code))
+        await send_response (send, finish_request (app, timings, response, TIME_SERIES_DATA_PATH))
+
+    async def application (scope, receive, send):
+        if scope ["type"] == "lifespan":
+            await lifespan (app, receive, send)
+            return
+
+        if scope ["type"] == "http" and scope ["path"] == TIME_SERIES_DATA_PATH and scope ["method"] == "POST":
+            callback = app.config ["callback_registry"].get ("time_series_batch_async")
+            if callback is not None:
+                await time_series_data (callback, scope, receive, send)
+                return
+
+        await wsgi (scope, receive, send)
+
+    return application
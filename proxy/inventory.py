@@ -0,0 +1,95 @@
+"""
+    Indexed view of the objects model, built once when the models are loaded so that object
+    searches do not scan the whole objects list for every filter.
+"""
+
+from bisect import bisect_left
+
+from portal.objects import ObjectDefinition
+
+class ObjectInventory (object):
+    """
+        Prebuilt ObjectDefinitions keyed by object_type_id and by (object_type_id, object_id).
+
+        Also holds a prefix index per object type over the lowercased display_name and object_id
+        of each object, as sorted arrays searched by bisection, for type-ahead searches.
+
+        objects
+            The list of object dictionaries from the objects model, each with an object_id,
+            display_name and object_type_id.
+    """
+
+    def __init__ (self, objects = None):
+        self.by_type = {}
+        self.by_key = {}
+
+        for portal_object in ([] if objects is None else objects):
+            self.add (portal_object)
+
+        self.prefix_keys = {}
+        self.prefix_entries = {}
+        for object_type_id, objs in self.by_type.items ():
+            index = []
+            for obj in objs:
+                index.append ((str (obj.display_name).lower (), 0, obj))
+                if obj.object_id != obj.display_name:
+                    index.append ((str (obj.object_id).lower (), 1, obj))
+            index.sort (key = lambda entry: (entry [0], entry [1]))
+            self.prefix_keys [object_type_id] = [entry [0] for entry in index]
+            self.prefix_entries [object_type_id] = [(entry [1], entry [2]) for entry in index]
+
+    def add (self, portal_object):
+        key = (portal_object ["object_type_id"], portal_object ["object_id"])
+
+        # Duplicate definitions of an object collapse onto the first one
+        if key in self.by_key:
+            return self.by_key [key]
+
+        obj = ObjectDefinition (object_type_id = portal_object ["object_type_id"], object_id = portal_object ["object_id"],
+            display_name = portal_object ["display_name"])
+        self.by_key [key] = obj
+        self.by_type.setdefault (obj.object_type_id, []).append (obj)
+
+        return obj
+
+    def get (self, object_type_id, object_id):
+        return self.by_key.get ((object_type_id, object_id))
+
+    def lookup (self, object_filter):
+        # Exact instance lookups are O(1), wildcard lookups return the objects of the type in model order
+        if object_filter.instance_id == "*":
+            return self.by_type.get (object_filter.object_type_id, [])
+
+        obj = self.by_key.get ((object_filter.object_type_id, object_filter.instance_id))
+        return [] if obj is None else [obj]
+
+    def type_ahead (self, search_string, object_type_ids = None, max_results = 20, max_scanned = 1000):
+        """
+            Objects whose display_name or object_id starts with search_string, case insensitively.
+            Exact matches rank first, then display name matches before object id matches, then
+            shorter names. At most max_scanned index entries are looked at per object type.
+        """
+        prefix = search_string.lower ()
+        if object_type_ids is None:
+            object_type_ids = list (self.prefix_keys.keys ())
+
+        candidates = {}
+        for object_type_id in object_type_ids:
+            keys = self.prefix_keys.get (object_type_id, [])
+            entries = self.prefix_entries.get (object_type_id, [])
+
+            position = bisect_left (keys, prefix)
+            end = min (position + max_scanned, len (keys))
+            while position < end and keys [position].startswith (prefix):
+                field, obj = entries [position]
+                rank = (keys [position] != prefix, field, len (keys [position]), keys [position])
+                key = (obj.object_type_id, obj.object_id)
+                if key not in candidates or rank < candidates [key][0]:
+                    candidates [key] = (rank, obj)
+                position += 1
+
+        ranked = sorted (candidates.values (), key = lambda candidate: candidate [0])
+        return [obj for rank, obj in ranked [:max (max_results, 0)]]
+
+    def __len__ (self):
+        return len (self.by_key)
@@ -0,0 +1,187 @@
+"""
+    Metrics of the proxy itself, in the Prometheus text exposition format.
+
+    Counters and histograms are kept in memory, one lock per metric, and rendered only when
+    /metrics is scraped, so they are cheap enough to leave on in production. Values that other
+    components already keep, such as the range cache counters, are read at scrape time through
+    collectors.
+"""
+
+import bisect
+import functools
+import inspect
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def label_value_escape (value):
+    return str (value).replace ("\\", "\\\\").replace ("\"", "\\\"").replace ("\n", "\\n")
+
+def labels_text (names, values):
+    if not names:
+        return ""
+    return "{" + ",".join (name + "=\"" + label_value_escape (value) + "\"" for name, value in zip (names, values)) + "}"
+
+def value_text (value):
+    if value == float ("inf"):
+        return "+Inf"
+    if isinstance (value, float) and value.is_integer ():
+        return str (int (value))
+    return repr (value)
+
+class Counter (object):
+    """
+        A counter per set of label values.
+    """
+
+    def __init__ (self, name, help, label_names = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple (label_names)
+        self.values = {}
+        self.lock = threading.Lock ()
+
+    def inc (self, amount = 1, *label_values):
+        with self.lock:
+            self.values [label_values] = self.values.get (label_values, 0) + amount
+
+    def lines (self):
+        with self.lock:
+            values = sorted (self.values.items ())
+
+        yield "# HELP " + self.name + " " + self.help
+        yield "# TYPE " + self.name + " counter"
+        for label_values, value in values:
+            yield self.name + labels_text (self.label_names, label_values) + " " + value_text (value)
+
+class Histogram (object):
+    """
+        A histogram per set of label values, with fixed bucket upper bounds.
+    """
+
+    def __init__ (self, name, help, label_names = (), buckets = DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple (label_names)
+        self.buckets = tuple (sorted (buckets))
+        self.values = {}
+        self.lock = threading.Lock ()
+
+    def observe (self, value, *label_values):
+        index = bisect.bisect_left (self.buckets, value)
+        with self.lock:
+            counts = self.values.get (label_values)
+            if counts is None:
+                # Per bucket counts, then the sum and count of the observations
+                counts = self.values [label_values] = [0] * (len (self.buckets) + 1) + [0.0, 0]
+            counts [index] += 1
+            counts [-2] += value
+            counts [-1] += 1
+
+    def lines (self):
+        with self.lock:
+            values = sorted ((label_values, list (counts)) for label_values, counts in self.values.items ())
+
+        yield "# HELP " + self.name + " " + self.help
+        yield "# TYPE " + self.name + " histogram"
+        bucket_names = self.label_names + ("le", )
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, count in zip (self.buckets + (float ("inf"), ), counts):
+                cumulative += count
+                yield self.name + "_bucket" + labels_text (bucket_names, label_values + (value_text (bound), )) + " " + str (cumulative)
+            yield self.name + "_sum" + labels_text (self.label_names, label_values) + " " + value_text (counts [-2])
+            yield self.name + "_count" + labels_text (self.label_names, label_values) + " " + str (counts [-1])
+
+class MetricsRegistry (object):
+    """
+        The metrics exposed on /metrics.
+
+        Collectors are functions called on every scrape, returning a list of
+        (name, type, help, [(labels dictionary, value)]) for values kept elsewhere.
+    """
+
+    def __init__ (self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter (self, name, help, label_names = ()):
+        counter = Counter (name, help, label_names)
+        self.metrics.append (counter)
+        return counter
+
+    def histogram (self, name, help, label_names = (), buckets = DURATION_BUCKETS):
+        histogram = Histogram (name, help, label_names, buckets)
+        self.metrics.append (histogram)
+        return histogram
+
+    def add_collector (self, collector):
+        self.collectors.append (collector)
+
+    def exposition (self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend (metric.lines ())
+
+        for collector in list (self.collectors):
+            for name, metric_type, help, samples in collector ():
+                lines.append ("# HELP " + name + " " + help)
+                lines.append ("# TYPE " + name + " " + metric_type)
+                for labels, value in samples:
+                    lines.append (name + labels_text (tuple (labels.keys ()), tuple (labels.values ())) + " " + value_text (value))
+
+        return "\n".join (lines) + "\n"
+
+class ProxyMetrics (MetricsRegistry):
+    """
+        The metrics of the proxy: durations per Portal route, callback and backend query, and
+        counts of the objects scanned, data points returned, bytes serialized and errors.
+    """
+
+    def __init__ (self):
+        super ().__init__ ()
+
+        self.request_seconds = self.histogram ("portal_proxy_request_duration_seconds",
+            "Time to answer a request, per route, method and status.", ("route", "method", "status"))
+        self.callback_seconds = self.histogram ("portal_proxy_callback_duration_seconds",
+            "Time spent in a data source callback.", ("callback", ))
+        self.backend_seconds = self.histogram ("portal_proxy_backend_query_duration_seconds",
+            "Time of a query to a backend target, per target and API path.", ("target", "path"))
+        self.objects_scanned = self.counter ("portal_proxy_objects_scanned_total",
+            "Objects examined to answer searches.", ("callback", ))
+        self.points_returned = self.counter ("portal_proxy_data_points_returned_total",
+            "Data points returned in time_series_data responses.")
+        self.bytes_serialized = self.counter ("portal_proxy_response_bytes_total",
+            "Bytes of JSON serialized for responses, per route.", ("route", ))
+        self.errors = self.counter ("portal_proxy_errors_total",
+            "Errors, per source: callback, backend or request.", ("source", "name"))
+
+    def timed_callback (self, name, function):
+        # Wraps a callback to observe its duration and count its errors; coroutine callbacks stay coroutines
+        if inspect.iscoroutinefunction (function):
+            @functools.wraps (function)
+            async def timed (*args, **kwargs):
+                start = time.perf_counter ()
+                try:
+                    return await function (*args, **kwargs)
+                except Exception:
+                    self.errors.inc (1, "callback", name)
+                    raise
+                finally:
+                    self.callback_seconds.observe (time.perf_counter () - start, name)
+            return timed
+
+        @functools.wraps (function)
+        def timed (*args, **kwargs):
+            start = time.perf_counter ()
+            try:
+                return function (*args, **kwargs)
+            except Exception:
+                self.errors.inc (1, "callback", name)
+                raise
+            finally:
+                self.callback_seconds.observe (time.perf_counter () - start, name)
+        return timed
@@ -0,0 +1,76 @@
+"""
+    Compiled cache of the parsed model files, so that workers do not re-parse unchanged YAML at startup.
+
+    Each model file gets a hidden cache file next to it, holding the parsed model in marshal format
+    together with the SHA-256 of the YAML it came from. The cache is only used while that hash still
+    matches; otherwise the YAML is parsed again, with the C-accelerated safe loader when available,
+    and the cache file is rewritten.
+"""
+
+import hashlib
+import marshal
+import os
+import tempfile
+import time
+import yaml
+
+CACHE_VERSION = 1
+
+YAML_LOADER = getattr (yaml, "CSafeLoader", yaml.SafeLoader)
+
+def cache_file (model_file):
+    directory, name = os.path.split (model_file)
+    return os.path.join (directory, "." + name + ".cache")
+
+def read_cache (path, digest):
+    try:
+        with open (path, "rb") as f:
+            cached = marshal.load (f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+    if not isinstance (cached, dict) or cached.get ("version") != CACHE_VERSION or cached.get ("digest") != digest:
+        return None
+
+    return cached
+
+def write_cache (path, digest, model):
+    # Written to a temporary file and renamed, so a concurrently starting worker never reads half a cache
+    try:
+        data = marshal.dumps ({"version": CACHE_VERSION, "digest": digest, "model": model})
+    except ValueError:
+        # Values marshal cannot hold (e.g. YAML timestamps) are simply not cached
+        return False
+
+    try:
+        fd, temp_path = tempfile.mkstemp (dir = os.path.dirname (path) or ".", prefix = os.path.basename (path) + ".")
+        with os.fdopen (fd, "wb") as f:
+            f.write (data)
+        os.replace (temp_path, path)
+    except OSError:
+        # A read-only model directory just means no cache
+        return False
+
+    return True
+
+def load_model_file (model_file, use_cache = True):
+    """
+        Returns (model, source, seconds), where source is "cache" or "yaml".
+    """
+    start = time.perf_counter ()
+
+    with open (model_file, "rb") as f:
+        data = f.read ()
+    digest = hashlib.sha256 (data).hexdigest ()
+
+    path = cache_file (model_file)
+    if use_cache:
+        cached = read_cache (path, digest)
+        if cached is not None:
+            return cached ["model"], "cache", time.perf_counter () - start
+
+    model = yaml.load (data, Loader = YAML_LOADER)
+    if use_cache:
+        write_cache (path, digest, model)
+
+    return model, "yaml", time.perf_counter () - start
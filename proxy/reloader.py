@@ -0,0 +1,74 @@
+"""
+    Background reloading of the model files, so inventory and catalog changes do not need a restart.
+"""
+
+import logging
+import os
+import threading
+
+logger = logging.getLogger (__name__)
+
+class ModelReloader (object):
+    """
+        Polls a set of model files and calls reload with the names of the files that changed.
+
+        files
+            Dictionary of model name to file path.
+
+        reload
+            Function called from the reloader thread with the list of changed model names. It is
+            expected to parse them and swap the new models in; requests keep using the current
+            models until it does.
+
+        interval_seconds
+            How often the files are checked for changes.
+    """
+
+    def __init__ (self, files, reload, interval_seconds = 30):
+        self.files = files
+        self.reload = reload
+        self.interval_seconds = interval_seconds
+
+        self.stamps = dict ((name, self.stamp (path)) for name, path in files.items ())
+        self.stopped = threading.Event ()
+        self.thread = None
+
+    def stamp (self, path):
+        # Modification time and size; a file that cannot be read is reported as None
+        try:
+            st = os.stat (path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def check (self):
+        changed = []
+        stamps = {}
+        for name, path in self.files.items ():
+            stamps [name] = self.stamp (path)
+            if stamps [name] is not None and stamps [name] != self.stamps.get (name):
+                changed.append (name)
+
+        if not changed:
+            return changed
+
+        # The new stamps are kept even if the reload fails, so a broken file is reported once per change
+        self.stamps.update (stamps)
+        try:
+            self.reload (changed)
+            logger.info ("Reloaded models: %s", ", ".join (changed))
+        except Exception:
+            logger.exception ("Failed to reload models %s, keeping the current models", ", ".join (changed))
+
+        return changed
+
+    def run (self):
+        while not self.stopped.wait (self.interval_seconds):
+            self.check ()
+
+    def start (self):
+        self.thread = threading.Thread (target = self.run, name = "model-reloader", daemon = True)
+        self.thread.start ()
+
+    def stop (self):
+        self.stopped.set ()
@@ -0,0 +1,144 @@
+"""
+    Per request phase timers, returned in a Server-Timing header and logged for slow requests,
+    and sampled cProfile profiles of whole requests.
+
+    The timers of the current request are kept in a context variable. Work handed to an executor
+    is submitted with submit (), which runs it in a copy of the submitting context, so phases
+    timed on worker threads still count towards their request.
+"""
+
+import contextvars
+import cProfile
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+current_timings = contextvars.ContextVar ("current_timings", default = None)
+
+class RequestTimings (object):
+    """
+        The time spent in each named phase of one request. Phases timed concurrently on several
+        threads add up, so their sum can exceed the duration of the request.
+
+        With profile set, the request's own thread and the work it submits to executors are each
+        profiled, and the profiles are merged when the request ends.
+    """
+
+    def __init__ (self, profile = False):
+        self.start = time.perf_counter ()
+        self.phases = {}
+        self.lock = threading.Lock ()
+
+        self.profiles = []
+        self.profile = None
+        if profile:
+            self.profile = cProfile.Profile ()
+            try:
+                self.profile.enable ()
+            except ValueError:
+                self.profile = None
+
+    def add (self, name, seconds):
+        with self.lock:
+            self.phases [name] = self.phases.get (name, 0.0) + seconds
+
+    def total (self):
+        return time.perf_counter () - self.start
+
+    def stop_profile (self):
+        if self.profile is None:
+            return None
+
+        self.profile.disable ()
+        with self.lock:
+            profiles = [self.profile] + self.profiles
+        self.profile = None
+        return pstats.Stats (*profiles)
+
+    def server_timing (self, total = None):
+        # Durations in milliseconds, as the Server-Timing header expects; without total, the phases so far
+        with self.lock:
+            phases = list (self.phases.items ())
+        if total is not None:
+            phases.append (("total", total))
+        return ", ".join ("%s;dur=%.1f" % (name, seconds * 1000) for name, seconds in phases)
+
+@contextmanager
+def phase (name):
+    timings = current_timings.get ()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter ()
+    try:
+        yield
+    finally:
+        timings.add (name, time.perf_counter () - start)
+
+def run_profiled (timings, function, *args, **kwargs):
+    # Profiles work running on a worker thread, as cProfile only sees the thread that enabled it
+    profile = cProfile.Profile ()
+    try:
+        profile.enable ()
+    except ValueError:
+        # Another profiler is already active, which newer Pythons allow only one of at a time
+        return function (*args, **kwargs)
+
+    try:
+        return function (*args, **kwargs)
+    finally:
+        profile.disable ()
+        with timings.lock:
+            timings.profiles.append (profile)
+
+def submit (executor, function, *args, **kwargs):
+    # executor.submit, keeping the request's timers (and profiling) on the worker thread
+    timings = current_timings.get ()
+    if timings is not None and timings.profile is not None:
+        return executor.submit (contextvars.copy_context ().run, run_profiled, timings, function, *args, **kwargs)
+
+    return executor.submit (contextvars.copy_context ().run, function, *args, **kwargs)
+
+def start_request (systems):
+    # Start the timers of a request, sampling it for profiling at the configured rate
+    rate = systems.get ("profile_sample_rate", 0.0)
+    timings = RequestTimings (profile = rate > 0 and random.random () < rate)
+    current_timings.set (timings)
+    return timings
+
+def finish_request (app, timings, response, route):
+    """
+        Ends the timers of a request: adds the Server-Timing header to the response, logs the
+        phases if the request was slow, and writes the profile if it was sampled.
+
+        A streamed response is only finished once its body has been sent, as that is when most
+        of its work is done. Its headers went out before, with the phases timed until then.
+    """
+    systems = app.config ["systems"]
+    total = timings.total ()
+    current_timings.set (None)
+
+    header = timings.server_timing (total)
+    if not response.is_streamed:
+        response.headers ["Server-Timing"] = header
+
+    slow_seconds = systems.get ("slow_request_seconds", 0)
+    if slow_seconds > 0 and total >= slow_seconds:
+        app.logger.warning ("Slow request %s took %.3fs: %s", route, total, header)
+
+    stats = timings.stop_profile ()
+    if stats is not None:
+        directory = systems.get ("profile_directory", "profiles")
+        name = "%d-%s-%dms.prof" % (time.time () * 1000, re.sub (r"[^A-Za-z0-9]+", "_", route).strip ("_"), total * 1000)
+        try:
+            os.makedirs (directory, exist_ok = True)
+            stats.dump_stats (os.path.join (directory, name))
+        except OSError:
+            app.logger.exception ("Could not write the profile of %s", route)
+
+    return response
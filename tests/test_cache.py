@@ -0,0 +1,102 @@
+"""
+    RangeCache: results served from the cache match the range queries they stand in for.
+"""
+
+import random
+
+import pytest
+
+pytest.importorskip ("requests")
+
+from prometheus.cache import RangeCache
+
+# Old enough that no chunk is within the recent window
+BASE = 1600000000
+
+class FakeTarget (object):
+    """
+        A range query against synthetic series: a sample at every evaluation timestamp from start
+        to end, for two label sets, one of which has a gap.
+    """
+
+    def __init__ (self):
+        self.queries = []
+
+    def fetch (self, query_string, start_time, end_time, step):
+        self.queries.append ((start_time, end_time, step))
+
+        series_list = []
+        for instance in ("a", "b"):
+            values = [[t, str (t % 97)] for t in range (start_time, end_time + 1, step)
+                      if not (instance == "b" and BASE + 3000 <= t < BASE + 6000)]
+            if values:
+                series_list.append ({"metric": {"instance": instance}, "values": values})
+        return series_list
+
+def test_cached_results_match_uncached_over_shifted_windows ():
+    random.seed (7)
+    target = FakeTarget ()
+    cache = RangeCache (max_points = 100000, chunk_points = 10, recent_seconds = 0)
+
+    for i in range (300):
+        step = random.choice ((15, 60, 300))
+        start_time = BASE + random.randrange (0, 20000)
+        end_time = start_time + random.randrange (0, 40) * step + random.choice ((0, 0, random.randrange (step)))
+
+        cached = cache.time_range_series (target.fetch, "up", start_time, end_time, step)
+        assert cached == target.fetch ("up", start_time, end_time, step)
+
+    assert cache.stats () ["hits"] > 0
+
+def test_repeated_request_is_served_from_the_cache ():
+    target = FakeTarget ()
+    cache = RangeCache (max_points = 100000, chunk_points = 10, recent_seconds = 0)
+
+    first = cache.time_range_series (target.fetch, "up", BASE + 60, BASE + 6000, 60)
+    fetched = len (target.queries)
+    assert fetched == 1
+
+    assert cache.time_range_series (target.fetch, "up", BASE + 60, BASE + 6000, 60) == first
+    assert len (target.queries) == fetched
+
+    # A window shifted by whole steps only fetches the chunks it does not share
+    cache.time_range_series (target.fetch, "up", BASE + 660, BASE + 6600, 60)
+    start_time, end_time, step = target.queries [-1]
+    assert len (target.queries) == fetched + 1
+    assert start_time > BASE + 6000 - 600 and end_time >= BASE + 6600
+
+def test_chunks_are_aligned_to_the_evaluation_timestamps ():
+    # Requests with a different phase against the step never share a chunk
+    target = FakeTarget ()
+    cache = RangeCache (max_points = 100000, chunk_points = 10, recent_seconds = 0)
+
+    cache.time_range_series (target.fetch, "up", BASE, BASE + 6000, 60)
+    shifted = cache.time_range_series (target.fetch, "up", BASE + 30, BASE + 6030, 60)
+
+    assert shifted == target.fetch ("up", BASE + 30, BASE + 6030, 60)
+    assert all (value [0] % 60 == (BASE + 30) % 60 for series in shifted for value in series ["values"])
+
+def test_recent_chunks_are_never_cached ():
+    import time
+
+    target = FakeTarget ()
+    cache = RangeCache (max_points = 100000, chunk_points = 10, recent_seconds = 300)
+
+    end_time = int (time.time ()) // 60 * 60
+    cache.time_range_series (target.fetch, "up", end_time - 600, end_time, 60)
+    cache.time_range_series (target.fetch, "up", end_time - 600, end_time, 60)
+
+    # The chunk holding the last 300 seconds is fetched again every time
+    assert len (target.queries) == 2
+    assert target.queries [-1][1] >= end_time
+
+def test_memory_is_bounded ():
+    target = FakeTarget ()
+    cache = RangeCache (max_points = 100, chunk_points = 10, recent_seconds = 0)
+
+    for i in range (20):
+        cache.time_range_series (target.fetch, "up", BASE + i * 6000, BASE + i * 6000 + 3000, 60)
+
+    stats = cache.stats ()
+    assert stats ["points"] <= 100
+    assert stats ["evictions"] > 0
@@ -0,0 +1,64 @@
+"""
+    portal.encoding.PortalEncoder: byte-identical to the json module through the attributes of the
+    Models, so a new field or slot cannot silently change what is sent to Portal.
+"""
+
+import json
+
+import pytest
+
+pytest.importorskip ("flask")
+
+from portal.encoding import PortalEncoder
+from portal.objects import *
+from proxy.app import PortalObjectJSONEncoder
+
+def search_response ():
+    objects = [ObjectDefinition (object_id = "host-1", display_name = "Hôte n°1 – 東京", object_type_id = "job",
+                                 object_properties = [ObjectProperty (id = "zone", value = "eu-west")]),
+               ObjectDefinition (object_id = "host-\"2\"\\", display_name = "Host\n2", object_type_id = "job")]
+    return SearchResponse (search_results = [SearchResult (obj = objects [0], value = 12.5,
+                                                           parent_object_filters = [ObjectFilter ("job", "*")]),
+                                             SearchResult (obj = objects [1], value = 3)], valid_interval = 120)
+
+def data_response ():
+    data_points = DataPointArray.from_pairs ([[1600000000, "1"], [1600000060, "0.1"], [1600000120.5, "1e-7"],
+                                              [1600000180, "1e22"], [1600000240, "-0.0"], [1600000300, "NaN"],
+                                              [1600000360, "+Inf"], [1600000420, "-Inf"]])
+    weighted = DataPointArray ([1600000000, 1600000300], [2.5, -3.75], [5.0, 1.0])
+    return DataResponse (data_request_id = 7, metric_values = [
+        MetricValue (metric_id = "up", statistic_id = "raw", data_points = data_points, last_valid_timestamp = 1600000420),
+        MetricValue (metric_id = "up", statistic_id = "avg", data_points = weighted, summary_rule = None),
+        MetricValue (metric_id = "cpu", statistic_id = "raw", data_points = [DataPoint (timestamp = 1600000000, value = 0.5)])])
+
+CASES = {
+    "search response": search_response,
+    "data responses": lambda: [data_response (), data_response ()],
+    "empty list": lambda: [],
+    "empty data points": lambda: DataResponse (data_request_id = 1, metric_values = [
+        MetricValue (metric_id = "up", statistic_id = "raw", data_points = DataPointArray ())]),
+    "catalog models": lambda: [Granularity (granularity_id = "1m", value_seconds = 60, time_window_seconds = 3600,
+                                            display_name = "1 Minute", storage_duration = 86400),
+                               Statistic (id = "p95", display_name = "95th percentile", is_default = False, is_primary = False),
+                               Preferences (), SoftwareVersion ("Prometheus", 1, 0, "1.0", 1, 1)],
+    "dict and scalars": lambda: {"status": "ok", "count": 3, "ratio": 0.25, "flag": True, "none": None,
+                                 "nested": {"b": [1, 2.0, "x"], "a": "é"}, "model": ObjectFilter ("job", "host-1")},
+    "floats": lambda: [0.1, 1e-7, 1e22, -0.0, 123456789.123456789, 2 ** 53 + 1.0, 1.5],
+}
+
+@pytest.mark.parametrize ("ensure_ascii", [True, False])
+@pytest.mark.parametrize ("name", sorted (CASES))
+def test_encode_matches_the_json_module (name, ensure_ascii):
+    obj = CASES [name] ()
+    expected = json.dumps (obj, cls = PortalObjectJSONEncoder, sort_keys = True, separators = (",", ":"),
+        ensure_ascii = ensure_ascii)
+
+    encoder = PortalEncoder (sort_keys = True, ensure_ascii = ensure_ascii)
+    assert encoder.encode (obj) == expected
+    assert "".join (encoder.iterencode (obj)) == expected
+
+def test_output_is_strict_json ():
+    # Non-finite data point values are null, so the output parses without NaN or Infinity
+    text = PortalEncoder ().encode (data_response ())
+    values = [data_point ["value"] for data_point in json.loads (text, parse_constant = pytest.fail) ["metric_values"][0]["data_points"]]
+    assert values [-3:] == [None, None, None]
@@ -0,0 +1,74 @@
+"""
+    prometheus.api.range_shards: sharded range queries cover the range exactly once.
+"""
+
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip ("requests")
+
+from prometheus.api import fetch_range_series, range_shards
+
+def evaluation_timestamps (start_time, end_time, step):
+    # The timestamps a range query evaluates at, as Prometheus does: start_time + k * step up to end_time
+    return list (range (start_time, end_time + 1, step))
+
+def test_shards_cover_the_range_without_duplicates ():
+    random.seed (18)
+    for i in range (2000):
+        step = random.choice ((1, 15, 60, 300, 3600))
+        start_time = 1600000000 + random.randrange (0, 10000)
+        end_time = start_time + random.randrange (0, 5000) * step + random.choice ((0, random.randrange (step)))
+        shard_points = random.choice ((1, 2, 7, 240, 1440, 11000))
+
+        shards = range_shards (start_time, end_time, step, shard_points)
+
+        timestamps = []
+        for shard_start, shard_end in shards:
+            # Each shard starts on the request's evaluation grid and holds at most shard_points steps
+            assert (shard_start - start_time) % step == 0
+            assert start_time <= shard_start <= shard_end <= end_time
+            shard_timestamps = evaluation_timestamps (shard_start, shard_end, step)
+            assert 1 <= len (shard_timestamps) <= shard_points
+            timestamps.extend (shard_timestamps)
+
+        assert timestamps == evaluation_timestamps (start_time, end_time, step)
+
+def test_sharding_is_disabled_or_skipped ():
+    assert range_shards (0, 6000, 60, 0) == [(0, 6000)]
+    assert range_shards (0, 600, 60, 1440) == [(0, 600)]
+    # Non integral times are passed through as they are
+    assert range_shards (0.5, 6000.5, 60, 10) == [(0.5, 6000.5)]
+
+class FakeClient (object):
+    """
+        Answers range queries with one series per instance, a sample at every evaluation timestamp.
+    """
+
+    def __init__ (self, shard_points):
+        self.shard_points = shard_points
+        self.shard_executor = ThreadPoolExecutor (max_workers = 4)
+        self.queries = 0
+
+    def post (self, path, data, timeout = None):
+        self.queries += 1
+        start_time, end_time, step = int (data ["start"]), int (data ["end"]), int (data ["step"])
+        result = [{"metric": {"instance": instance}, "values": [[t, str (t)] for t in evaluation_timestamps (start_time, end_time, step)]}
+                  for instance in ("b", "a")]
+        return {"status": "success", "data": {"resultType": "matrix", "result": result}}
+
+def test_sharded_query_matches_one_query ():
+    unsharded = FakeClient (0)
+    sharded = FakeClient (7)
+
+    expected = fetch_range_series (unsharded, "up", 1600000000, 1600006000, 60)
+    series_list = fetch_range_series (sharded, "up", 1600000000, 1600006000, 60)
+
+    assert sharded.queries == len (range_shards (1600000000, 1600006000, 60, 7)) > 1
+    assert sorted (series_list, key = lambda series: series ["metric"]["instance"]) == \
+        sorted (expected, key = lambda series: series ["metric"]["instance"])
+    for series in series_list:
+        timestamps = [value [0] for value in series ["values"]]
+        assert timestamps == sorted (set (timestamps))
@@ -0,0 +1,97 @@
+"""
+    prometheus.api.SingleFlight: concurrent callers of one key share a single call.
+"""
+
+import threading
+import time
+
+import pytest
+
+pytest.importorskip ("requests")
+
+from prometheus.api import SingleFlight
+
+CALLERS = 8
+
+class Interrupted (BaseException):
+    pass
+
+def run_concurrently (single_flight, function):
+    """
+        Calls single_flight.do with the same key from CALLERS threads, all started together, and
+        holds function until every caller has joined the call. Returns each caller's result or
+        exception.
+    """
+    barrier = threading.Barrier (CALLERS)
+    release = threading.Event ()
+    calls = []
+    outcomes = [None] * CALLERS
+
+    def gated ():
+        calls.append (1)
+        release.wait (5)
+        return function ()
+
+    def caller (index):
+        barrier.wait ()
+        try:
+            outcomes [index] = ("result", single_flight.do ("key", gated))
+        except BaseException as error:
+            outcomes [index] = ("error", error)
+
+    threads = [threading.Thread (target = caller, args = (index, )) for index in range (CALLERS)]
+    for thread in threads:
+        thread.start ()
+
+    deadline = time.monotonic () + 5
+    while single_flight.stats () ["coalesced"] < CALLERS - 1 and time.monotonic () < deadline:
+        time.sleep (0.001)
+    release.set ()
+
+    for thread in threads:
+        thread.join ()
+
+    return len (calls), outcomes
+
+def test_callers_share_one_call_and_its_result ():
+    single_flight = SingleFlight ()
+    result = {"series": []}
+
+    calls, outcomes = run_concurrently (single_flight, lambda: result)
+
+    assert calls == 1
+    assert all (kind == "result" and value is result for kind, value in outcomes)
+
+    stats = single_flight.stats ()
+    assert stats ["calls"] == 1
+    assert stats ["coalesced"] == CALLERS - 1
+    assert stats ["coalescing_ratio"] == pytest.approx ((CALLERS - 1) / CALLERS)
+
+def raise_error (error):
+    raise error
+
+def test_an_exception_reaches_every_caller ():
+    single_flight = SingleFlight ()
+    error = ValueError ("backend down")
+
+    calls, outcomes = run_concurrently (single_flight, lambda: raise_error (error))
+
+    assert calls == 1
+    assert all (kind == "error" and value is error for kind, value in outcomes)
+
+def test_a_base_exception_reaches_every_caller ():
+    single_flight = SingleFlight ()
+    error = Interrupted ()
+
+    calls, outcomes = run_concurrently (single_flight, lambda: raise_error (error))
+
+    assert calls == 1
+    assert all (kind == "error" and value is error for kind, value in outcomes)
+
+def test_later_callers_start_a_new_call ():
+    single_flight = SingleFlight ()
+    counter = iter (range (10))
+
+    assert single_flight.do ("key", lambda: next (counter)) == 0
+    assert single_flight.do ("key", lambda: next (counter)) == 1
+    assert single_flight.stats () ["coalescing_ratio"] == 0.0
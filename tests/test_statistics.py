@@ -0,0 +1,107 @@
+"""
+    portal.statistics: the NumPy bucket statistics against a naive computation per bucket.
+"""
+
+import math
+import random
+
+import pytest
+
+numpy = pytest.importorskip ("numpy")
+
+from portal.statistics import percentile, resolution, statistic_functions, summarize
+
+def naive_percentile (values, q):
+    # Linear interpolation between the closest ranks
+    values = sorted (values)
+    position = (len (values) - 1) * q / 100.0
+    lower = int (math.floor (position))
+    upper = int (math.ceil (position))
+    return values [lower] + (values [upper] - values [lower]) * (position - lower)
+
+def naive_summarize (pairs, function, start_time, end_time, step):
+    # [(timestamp, value, weight)] of each bucket (t - step, t] with samples, t from start_time to end_time
+    points = []
+    t = start_time
+    while t <= end_time:
+        if function == "raw":
+            points.extend ((t, float (value), 1.0) for timestamp, value in pairs if timestamp == t)
+        else:
+            values = [float (value) for timestamp, value in pairs
+                      if t - step < timestamp <= t and not math.isnan (float (value))]
+            if values:
+                if function == "avg":
+                    result = sum (values) / len (values)
+                elif function == "min":
+                    result = min (values)
+                elif function == "max":
+                    result = max (values)
+                elif function == "sum":
+                    result = sum (values)
+                elif function == "count":
+                    result = float (len (values))
+                else:
+                    result = naive_percentile (values, percentile (function))
+                points.append ((t, result, float (len (values))))
+        t += step
+
+    return points
+
+def samples (start_time, end_time, fine_step, seed):
+    # Samples at a fine step reaching back before start_time, with gaps and NaNs
+    rng = random.Random (seed)
+    pairs = []
+    for t in range (start_time - 600, end_time + 600, fine_step):
+        r = rng.random ()
+        if r < 0.1:
+            continue
+        pairs.append ([t, "NaN" if r < 0.15 else str (round (rng.uniform (-50, 50), 3))])
+    return pairs
+
+@pytest.mark.parametrize ("function", ["raw", "avg", "min", "max", "sum", "count", "p50", "p95", "p99.9", "p0", "p100"])
+@pytest.mark.parametrize ("step, fine_step", [(300, 60), (300, 15), (60, 60), (3600, 300)])
+def test_summarize_matches_a_naive_computation_per_bucket (function, step, fine_step):
+    start_time = 1600000200
+    end_time = start_time + 12 * step
+    pairs = samples (start_time, end_time, fine_step, seed = step + fine_step)
+
+    data_points = summarize (pairs, function, start_time, end_time, step)
+    expected = naive_summarize (pairs, function, start_time, end_time, step)
+
+    assert len (data_points) == len (expected)
+    for index, (timestamp, value, weight) in enumerate (expected):
+        assert data_points.timestamps [index] == timestamp
+        assert data_points.weight_value (index) == weight
+        if math.isnan (value):
+            assert math.isnan (data_points.values [index])
+        else:
+            assert data_points.values [index] == pytest.approx (value, rel = 1e-12, abs = 1e-9)
+
+def test_bucket_edges ():
+    # A sample at t belongs to the bucket ending at t, not to the next one, so the sample at 940 is left out
+    pairs = [[940, "1"], [1000, "2"], [1001, "4"], [1060, "8"]]
+
+    data_points = summarize (pairs, "sum", 1000, 1060, 60)
+    assert list (data_points.timestamps) == [1000, 1060]
+    assert list (data_points.values) == [2.0, 12.0]
+    assert list (data_points.weight_values) == [1.0, 2.0]
+
+def test_empty_series ():
+    assert len (summarize ([], "avg", 0, 600, 60)) == 0
+    assert len (summarize ([[60, "NaN"]], "max", 0, 600, 60)) == 0
+
+def test_resolution_divides_the_step ():
+    for step in (60, 300, 900, 3600, 28800, 86400):
+        for points in (100, 11000):
+            fine_step = resolution (0, 30 * 86400, step, 60, points)
+            assert step % fine_step == 0
+            assert fine_step >= min (60, step)
+
+    assert resolution (0, 3600, 300, 60, 11000) == 60
+    # 90000 seconds of samples in at most 100 points: 900 is the smallest divisor of 3600 that fits
+    assert resolution (0, 86400, 3600, 60, 100) == 900
+
+def test_statistic_functions ():
+    functions = statistic_functions ([{"id": "raw"}, {"id": "p95"}, {"id": "mean", "function": "avg"}, {"id": "median", "function": "p50"},
+                                      {"id": "unknown"}, {"id": "p101"}])
+    assert functions == {"raw": "raw", "p95": "p95", "mean": "avg", "median": "p50", "unknown": "raw", "p101": "raw"}